@@ -0,0 +1,526 @@
+import asyncio
+import random
+import re
+import json
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+
+import httpx
+from bson import ObjectId
+from fastapi import FastAPI
+
+import main
+from main import CRUDRouterFactory, MessageLog, MirraRepository, Person, field_value
+
+# run from the repo root:  python bench.py [name ...]
+# uses an in-process fake store, no mongod needed
+
+
+OPERATORS = {
+    "$eq": lambda a, b: a == b,
+    "$ne": lambda a, b: a != b,
+    "$gt": lambda a, b: a is not None and a > b,
+    "$gte": lambda a, b: a is not None and a >= b,
+    "$lt": lambda a, b: a is not None and a < b,
+    "$lte": lambda a, b: a is not None and a <= b,
+    "$in": lambda a, b: a in b,
+    "$regex": lambda a, b: isinstance(a, str) and re.match(b, a) is not None,
+}
+
+
+def match(doc: dict, query: dict) -> bool:
+    # the subset of the Mongo query language the routers generate
+    for k, v in query.items():
+        if k == "$and":
+            if not all(match(doc, q) for q in v):
+                return False
+        elif k == "$or":
+            if not any(match(doc, q) for q in v):
+                return False
+        elif isinstance(v, dict) and v and all(op.startswith("$") for op in v):
+            if not all(OPERATORS[op](field_value(doc, k), arg) for op, arg in v.items()):
+                return False
+        elif field_value(doc, k) != v:
+            return False
+    return True
+
+
+def project(doc: dict, projection: dict = None) -> dict:
+    # top-level inclusion projections only
+    if not projection:
+        return dict(doc)
+    return {k: v for k, v in doc.items() if k in projection}
+
+
+class MemoryRepository(MirraRepository):
+    # fake backend with simulated round-trip latency - blocking=True sleeps on
+    # the event loop the way the synchronous pymongo driver did
+    def __init__(self, latency: float = 0.002, slow_latency: float = 0.1, slow_every: int = 50, blocking: bool = False):
+        self.docs: dict[str, dict] = {}
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_every = slow_every
+        self.blocking = blocking
+        self.calls = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        delay = self.slow_latency if self.slow_every and self.calls % self.slow_every == 0 else self.latency
+        if self.blocking:
+            time.sleep(delay)
+        else:
+            await asyncio.sleep(delay)
+
+    def _write(self, item_id, doc):
+        # $set + $inc _v, returning the document before and after
+        before = self.docs[item_id]
+        after = {**before, **{k: v for k, v in doc.items() if k != "_v"}, "_v": before.get("_v", 0) + 1}
+        self.docs[item_id] = after
+        return dict(before), dict(after)
+
+    async def insert(self, doc):
+        await self._round_trip()
+        doc["_v"] = 1
+        self.docs[doc["_id"]] = dict(doc)
+        return dict(doc)
+
+    async def get(self, item_id, projection=None):
+        await self._round_trip()
+        doc = self.docs.get(item_id)
+        return project(doc, projection) if doc else None
+
+    async def find(self, query, sort=None, skip=0, limit=0, batch_size=0, projection=None):
+        await self._round_trip()
+        docs = [d for d in self.docs.values() if match(d, query)]
+        for field, direction in reversed(sort or []):
+            docs.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        docs = docs[skip:skip + limit] if limit else docs[skip:]
+        for doc in docs:
+            yield project(doc, projection)
+
+    async def update(self, item_id, doc):
+        result = await self.patch(item_id, doc)
+        return result[1] if result else None
+
+    async def patch(self, item_id, doc):
+        await self._round_trip()
+        if item_id not in self.docs:
+            return None
+        return self._write(item_id, doc)
+
+    async def delete(self, item_id):
+        return await self.update(item_id, {"_x": True})
+
+    async def insert_many(self, docs):
+        if not docs:
+            # as pymongo does
+            raise TypeError("documents must be a non-empty list")
+        await self._round_trip()
+        errors = []
+        for doc in docs:
+            doc.setdefault("_id", f"m{len(self.docs)}")
+            doc["_v"] = 1
+            errors.append("duplicate" if doc["_id"] in self.docs else None)
+            self.docs.setdefault(doc["_id"], dict(doc))
+        return errors
+
+    async def update_many(self, docs):
+        await self._round_trip()
+        return {i: self._write(i, doc)[1] for i, doc in docs.items() if i in self.docs}, {}
+
+    async def delete_many(self, ids):
+        return (await self.update_many({i: {"_x": True} for i in ids}))[0]
+
+
+class MemoryMessageLog(MessageLog):
+    def __init__(self):
+        self.messages: list[dict] = []
+        self.high = 0
+        self.trimmed = 0
+        self.unsent = set()
+        self.next = self.block_end = 0
+        self.lows = {}
+
+    async def next_id(self):
+        self.high += 1
+        return self.high
+
+    async def append(self, message):
+        msg = {**message, "id": await self.next_id()}
+        self.messages.append({**msg, "at": datetime.now(timezone.utc)})
+        return msg
+
+    async def last_id(self):
+        return self.high
+
+    async def since(self, last_id, limit=0):
+        messages = [{k: v for k, v in m.items() if k != "at"} for m in self.messages if m["id"] > last_id]
+        return messages[:limit] if limit else messages
+
+    async def floor(self):
+        return self.trimmed
+
+    async def trim(self, floor):
+        self.trimmed = max(self.trimmed, floor)
+        count = len(self.messages)
+        self.messages = [m for m in self.messages if m["id"] > floor]
+        return count - len(self.messages)
+
+    async def older_than(self, cutoff):
+        return next((m["id"] - 1 for m in self.messages if m["at"] >= cutoff), self.high)
+
+    async def compact(self, upto):
+        deletes, rewrites = main.compacted([m for m in self.messages if m["id"] <= upto])
+        deletes, rewrites = set(deletes), {m["id"]: m for m in rewrites}
+        self.messages = [rewrites.get(m["id"], m) for m in self.messages if m["id"] not in deletes]
+        return len(deletes), len(rewrites)
+
+
+class ReadAfterWriteRepository(MemoryRepository):
+    # the write pattern MongoRepository used before find_one_and_update:
+    # insert+find, update+find, find+update+find
+    async def insert(self, doc):
+        await self._round_trip()
+        return await super().insert(doc)
+
+    async def patch(self, item_id, doc):
+        await self._round_trip()
+        return await super().patch(item_id, doc)
+
+    async def delete(self, item_id):
+        await self._round_trip()
+        return await super().delete(item_id)
+
+
+def make_app(repository: MirraRepository) -> FastAPI:
+    main.manager.log = MemoryMessageLog()
+    main.cache.entries.clear()
+    app = FastAPI()
+    app.include_router(CRUDRouterFactory(Person, repository, "persons").get_router("/persons"))
+    return app
+
+
+def seed(repository: MemoryRepository, n: int):
+    for i in range(n):
+        repository.docs[f"p{i}"] = {"_id": f"p{i}", "name": f"person {i}", "_x": False}
+
+
+def report(label: str, latencies: list[float], elapsed: float):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"  {label:<10} {len(latencies) / elapsed:>9.0f} req/s   p50 {p50:>7.1f} ms   p99 {p99:>7.1f} ms")
+
+
+async def concurrency(requests: int = 1000, rate: int = 400):
+    # open-loop mixed reads/writes arriving at a fixed rate, with one slow
+    # round-trip in every 50 - latency is measured from each request's arrival,
+    # so a blocking driver shows every request queueing behind the slow ones
+    print(f"concurrency: {requests} requests arriving at {rate}/s")
+    for blocking in (True, False):
+        repository = MemoryRepository(blocking=blocking)
+        seed(repository, 1000)
+        transport = httpx.ASGITransport(app=make_app(repository))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            latencies = []
+
+            async def one(i, arrival):
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+                key = f"p{random.randrange(1000)}"
+                if i % 2:
+                    r = await http.get(f"/persons/{key}")
+                else:
+                    r = await http.put(f"/persons/{key}", json={"name": f"renamed {i}"})
+                r.raise_for_status()
+                latencies.append(time.perf_counter() - arrival)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i, start + i / rate) for i in range(requests)))
+            report("blocking" if blocking else "async", latencies, time.perf_counter() - start)
+
+
+async def writes(requests: int = 1000, concurrent: int = 20, latency: float = 0.05):
+    # create / update / delete throughput on /persons. The round-trip is long
+    # enough that storage is what limits throughput - with a 1 ms one the
+    # in-process ASGI stack is, and both sides run at the same rate
+    print(f"writes: {requests} requests, {concurrent} in flight, {latency * 1000:.0f} ms round-trip")
+    for label, cls in (("before", ReadAfterWriteRepository), ("after", MemoryRepository)):
+        repository = cls(latency=latency, slow_every=0)
+        seed(repository, 1000)
+        transport = httpx.ASGITransport(app=make_app(repository))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            gate = asyncio.Semaphore(concurrent)
+            latencies = []
+
+            async def one(i):
+                async with gate:
+                    start = time.perf_counter()
+                    if i % 3 == 0:
+                        r = await http.post("/persons", json={"_id": f"n{i}", "name": f"new {i}"})
+                    elif i % 3 == 1:
+                        r = await http.put(f"/persons/p{i % 1000}", json={"name": f"renamed {i}"})
+                    else:
+                        r = await http.delete(f"/persons/p{i % 1000}")
+                    r.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(requests)))
+            report(label, latencies, time.perf_counter() - start)
+            print(f"  {'':<10} {repository.calls / requests:>9.2f} round-trips per write")
+
+
+async def serialize(docs: int = 1000, rounds: int = 20):
+    # docs/sec reading a page of 1000 wide documents through GET /persons,
+    # validating every document vs. the trusted path straight to JSON
+    print(f"serialize: {rounds} x GET /persons?limit={docs}, 20 extra fields per doc")
+    for label, trusted in (("validated", False), ("trusted", True)):
+        repository = MemoryRepository(latency=0, slow_every=0)
+        for i in range(docs):
+            repository.docs[f"p{i}"] = {
+                "_id": ObjectId(), "name": f"person {i}", "_t": 1700000000000 + i, "_u": "bench", "_x": False,
+                **{f"extra{j}": f"value {i}.{j}" for j in range(20)},
+            }
+        app = FastAPI()
+        app.include_router(CRUDRouterFactory(Person, repository, "persons", trusted_reads=trusted).get_router("/persons"))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                r = await http.get(f"/persons?limit={docs}")
+                r.raise_for_status()
+            elapsed = time.perf_counter() - start
+        print(f"  {label:<10} {docs * rounds / elapsed:>9.0f} docs/s")
+
+
+async def coalescing(editors: int = 20, keystrokes: int = 50, interval: float = 0.01):
+    # editors typing into their own item, saving on each keystroke - counts
+    # the messages logged (and so frames sent) with and without a window
+    print(f"coalescing: {editors} editors x {keystrokes} keystroke saves, {interval * 1000:.0f} ms apart")
+    for window in (0.0, 0.05, 0.2):
+        repository = MemoryRepository(latency=0.001, slow_every=0)
+        seed(repository, editors)
+        app = make_app(repository)
+        manager = main.ConnectionManager(main.manager.log, main.LocalBus(), coalesce=window)
+        main.manager, saved = manager, main.manager
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+                async def edit(i):
+                    for k in range(keystrokes):
+                        r = await http.patch(f"/persons/p{i}", json={"name": "x" * k})
+                        r.raise_for_status()
+                        await asyncio.sleep(interval)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(edit(i) for i in range(editors)))
+                await manager.flush()
+                elapsed = time.perf_counter() - start
+            stats = manager.stats()["coalescing"]
+            print(f"  {window * 1000:>4.0f} ms   {stats['changes'] / elapsed:>7.0f} saves/s   "
+                  f"{stats['frames']:>5} messages logged   ratio {stats['ratio']:>6.2f}   batching {stats['batching']:>7.2f}")
+        finally:
+            main.manager = saved
+
+
+def person_events(n: int) -> list[dict]:
+    # what a /persons burst looks like on /ws - mostly keystroke patches, some
+    # whole documents from PUT and create
+    events = []
+    for i in range(n):
+        key = f"p{i % 100}"
+        if i % 10:
+            events.append({"entity": f"/persons/{key}", "mode": "patch", "key": key, "base": i,
+                           "delta": {"name": f"person {i}", "_t": 1700000000000 + i, "_v": i + 1}, "id": i + 1})
+        else:
+            events.append({"entity": f"/persons/{key}", "mode": "update", "key": key, "id": i + 1, "data": {
+                "_id": key, "name": f"person {i}", "_t": 1700000000000 + i, "_u": "bench", "_x": False, "_v": i + 1}})
+    return events
+
+
+def deflate():
+    # permessage-deflate as browsers negotiate it: raw deflate, the window
+    # kept across messages, each message flushed and its 4-byte tail dropped
+    compressor = zlib.compressobj(wbits=-15)
+    return lambda payload: len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+async def wire(events: int = 5000, replay_batch: int = 500):
+    # bytes on the wire and encode time per message for /persons change
+    # events, sent one per frame and as messagesSince replay batches
+    print(f"wire: {events} /persons change events, and as replay batches of {replay_batch}")
+    messages = person_events(events)
+    batches = [{"messages": messages[i:i + replay_batch], "last_id": messages[min(i + replay_batch, events) - 1]["id"]}
+               for i in range(0, events, replay_batch)]
+    encoders = {"json (before)": json.dumps, **main.WIRE_ENCODINGS}
+    if "msgpack" not in encoders:
+        print("  (msgpack isn't installed - pip install msgpack to include it)")
+    for label, frames in (("events", messages), ("replay", batches)):
+        for name, encode in encoders.items():
+            for compressed in (False, True):
+                size = deflate() if compressed else len
+                start = time.perf_counter()
+                total = 0
+                for frame in frames:
+                    payload = encode(frame)
+                    total += size(payload if isinstance(payload, bytes) else payload.encode())
+                elapsed = time.perf_counter() - start
+                print(f"  {label:<7} {name + (' + deflate' if compressed else ''):<24} "
+                      f"{total / events:>7.1f} bytes/event   {elapsed / events * 1e6:>6.2f} us/event")
+
+
+class QuietSocket:
+    # a connected browser that reads everything and never says anything
+    async def send_text(self, payload):
+        pass
+
+    async def send_bytes(self, payload):
+        pass
+
+
+async def heartbeat(sockets: int = 20000, interval: float = 30.0):
+    # the longest the event loop is held by liveness work, with every socket
+    # due a ping: one sweep over everything (the old ping loop) vs. buckets
+    print(f"heartbeat: {sockets} idle sockets, {interval:.0f} s interval")
+    for buckets in (1, 30, 300):
+        manager = main.ConnectionManager(MemoryMessageLog(), main.LocalBus(), ping_interval=interval)
+        manager.heartbeat = main.Heartbeat(manager, interval, buckets)
+        for _ in range(sockets):
+            websocket = QuietSocket()
+            connection = main.ClientConnection(manager, websocket, manager.max_queue)
+            connection.last_seen -= interval
+            manager.active_connections[websocket] = connection
+            manager.heartbeat.add(websocket)
+        for _ in range(buckets):
+            manager.heartbeat.beat()
+            await asyncio.sleep(0)
+        stats = manager.heartbeat.stats()
+        print(f"  {buckets:>4} buckets   tick every {interval / buckets * 1000:>6.0f} ms   "
+              f"longest tick {stats['max_tick_ms']:>7.2f} ms   sweep {stats['sweep_ms']:>7.2f} ms   {stats['pings']} pings")
+        for connection in manager.active_connections.values():
+            connection.stop()
+
+
+def replay_state(messages: list[dict], truth: dict, docs: dict = None) -> tuple[dict, int]:
+    # what a client holding docs ends up with after replaying messages, the way
+    # mirra.js applies them - and how many items it had to reload from the server
+    docs, reloads = dict(docs or {}), 0
+    for msg in messages:
+        for change in msg.get("changes") or [msg]:
+            key, doc = change["key"], docs.get(change["key"])
+            if change["mode"] == "patch":
+                if doc and doc["_v"] == change["base"]:
+                    docs[key] = {**doc, **change["delta"]}
+                elif doc and doc["_v"] < change["delta"]["_v"]:
+                    docs[key] = dict(truth[key])
+                    reloads += 1
+            elif not doc or doc["_v"] <= change["data"]["_v"]:
+                docs[key] = change["data"]
+    return docs, reloads
+
+
+async def retention(items: int = 200, changes: int = 50000, window: int = 1000):
+    # a long-running log: items created, then edited over and over. Compacting
+    # everything but the last window messages - log size and replay cost from
+    # the start and from the middle, and whether replaying still ends up with
+    # the same documents
+    print(f"retention: {items} items, {changes} changes, compacting all but the last {window} messages")
+    log = MemoryMessageLog()
+    truth = {}
+    for i in range(changes):
+        key = f"p{i % items}"
+        if key not in truth:
+            truth[key] = {"_id": key, "name": "new", "_v": 1}
+            await log.append({"entity": "/persons", "mode": "create", "key": key, "data": truth[key]})
+        else:
+            before = truth[key]
+            truth[key] = {**before, "name": f"edit {i}", "_v": before["_v"] + 1}
+            await log.append({"entity": f"/persons/{key}", "mode": "patch", "key": key, "base": before["_v"],
+                              "delta": {"name": truth[key]["name"], "_v": truth[key]["_v"]}})
+    # what a client that last saw the middle of the log holds
+    held, _ = replay_state(await log.since(0, changes // 2), truth)
+    for label in ("before", "after"):
+        if label == "after":
+            start = time.perf_counter()
+            job = main.Retention(log, compact_window=window)
+            await job.run()
+            print(f"  compacted in {(time.perf_counter() - start) * 1000:.0f} ms: {job.stats()['compacted']} messages removed")
+        for since in (0, changes // 2):
+            start = time.perf_counter()
+            messages = await log.since(since)
+            elapsed = time.perf_counter() - start
+            docs, reloads = replay_state(messages, truth, held if since else None)
+            print(f"  {label:<7} {len(log.messages):>6} messages   replay from {since:>5}: "
+                  f"{len(messages):>6} messages {elapsed * 1000:>6.1f} ms   {reloads:>3} reloads   "
+                  f"same documents: {docs == truth}")
+
+
+async def bootstrap(docs: int = 20000):
+    # a browser loading every person: GET /persons a page at a time following
+    # X-Next-Cursor, vs. one GET /persons/snapshot
+    print(f"bootstrap: loading {docs} persons with a 1 ms round-trip")
+    repository = MemoryRepository(latency=0.001, slow_every=0)
+    seed(repository, docs)
+    transport = httpx.ASGITransport(app=make_app(repository))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        start = time.perf_counter()
+        loaded, requests, cursor = 0, 0, None
+        while True:
+            r = await http.get("/persons", params={"limit": 1000, **({"cursor": cursor} if cursor else {})})
+            requests += 1
+            loaded += len(r.json())
+            cursor = r.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        print(f"  {'pages':<10} {loaded:>6} docs   {requests:>3} requests   {(time.perf_counter() - start) * 1000:>6.0f} ms   no message id")
+        start = time.perf_counter()
+        r = await http.get("/persons/snapshot")
+        loaded = sum(1 for line in r.text.splitlines() if line)
+        print(f"  {'snapshot':<10} {loaded:>6} docs   {1:>3} requests   {(time.perf_counter() - start) * 1000:>6.0f} ms   "
+              f"replay from {r.headers['X-Last-Message-Id']}")
+
+
+async def conditional(rounds: int = 200, docs: int = 1000):
+    # re-reading data that hasn't changed: a page of GET /persons and single
+    # GET /persons/{id}, plain vs. sending back the ETag from the first read
+    print(f"conditional: {rounds} re-reads of unchanged data, 20 extra fields per doc")
+    repository = MemoryRepository(latency=0, slow_every=0)
+    for i in range(docs):
+        repository.docs[f"p{i}"] = {
+            "_id": f"p{i}", "name": f"person {i}", "_t": 1700000000000 + i, "_u": "bench", "_x": False, "_v": 1,
+            **{f"extra{j}": f"value {i}.{j}" for j in range(20)},
+        }
+    transport = httpx.ASGITransport(app=make_app(repository))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        for label, url in ((f"list {docs}", f"/persons?limit={docs}"), ("single", "/persons/p1")):
+            etag = (await http.get(url)).headers["ETag"]
+            for conditional in (False, True):
+                headers = {"If-None-Match": etag} if conditional else {}
+                received = 0
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    r = await http.get(url, headers=headers)
+                    received += len(r.content)
+                elapsed = time.perf_counter() - start
+                print(f"  {label:<10} {'If-None-Match' if conditional else 'plain':<14} {r.status_code}   "
+                      f"{rounds / elapsed:>7.0f} req/s   {received / rounds:>9.0f} bytes/response")
+
+
+BENCHMARKS = {
+    "concurrency": concurrency,
+    "writes": writes,
+    "serialize": serialize,
+    "coalescing": coalescing,
+    "wire": wire,
+    "heartbeat": heartbeat,
+    "retention": retention,
+    "bootstrap": bootstrap,
+    "conditional": conditional,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        asyncio.run(BENCHMARKS[name]())
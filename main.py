@@ -1,30 +1,85 @@
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+import base64
+import hashlib
+import heapq
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pymongo import MongoClient
+from fastapi.responses import FileResponse, StreamingResponse
+from pymongo import AsyncMongoClient, DeleteMany, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from pydantic import BaseModel, BeforeValidator, Field, ConfigDict, field_serializer
-from typing import Annotated, List, Optional, get_type_hints, Any
-from bson import ObjectId
+from typing import Annotated, AsyncIterator, ClassVar, Dict, List, Optional, Tuple, Union, get_args, get_origin, Any
+from types import UnionType
+from bson import ObjectId, json_util
 
 from contextlib import asynccontextmanager
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start the ping loop when app starts
-    async def ping_loop():
-        while True:
-            await manager.ping_clients()
-            await asyncio.sleep(30)
+    await ensure_indexes()
+    if os.environ.get("MIRRA_COLLSCAN_REPORT"):
+        await profile_collscans()
+    await manager.log.start()
 
-    task = asyncio.create_task(ping_loop())
+    await manager.heartbeat.start()
+    await retention.start()
+    await manager.bus.start()
     yield
     # Cleanup on shutdown
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    await manager.flush()
+    await manager.bus.stop()
+    await manager.log.stop()
+    await retention.stop()
+    await manager.heartbeat.stop()
+    await client.close()
+
+async def ensure_indexes():
+    await manager.log.ensure_indexes()
+    for factory in CRUDRouterFactory.factories:
+        await factory.ensure_indexes()
+
+async def profile_collscans():
+    # have mongod record every query that had to scan a whole collection
+    await db.command("profile", 1, filter={"planSummary": "COLLSCAN"})
+
+async def collscan_report() -> List[dict]:
+    pipeline = [
+        {"$match": {"planSummary": "COLLSCAN"}},
+        {"$group": {
+            "_id": {"ns": "$ns", "op": "$op"},
+            "count": {"$sum": 1},
+            "docs_examined": {"$sum": "$docsExamined"},
+            "max_ms": {"$max": "$millis"},
+            "last": {"$max": "$ts"},
+            "filter": {"$last": "$command.filter"},
+            "sort": {"$last": "$command.sort"},
+        }},
+        {"$sort": {"count": -1}},
+    ]
+    cursor = await db["system.profile"].aggregate(pipeline)
+    return [{**r.pop("_id"), **r} async for r in cursor]
+
+logger = logging.getLogger("mirra")
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -37,62 +92,1185 @@ def root():
 def rootTest():
     return FileResponse("static/test.html")
 
-client = MongoClient("mongodb://localhost:27017/")
+@app.get("/metrics")
+def metrics():
+    return {
+        "websockets": manager.stats(),
+        "cache": cache.stats(),
+        "retention": retention.stats(),
+    }
+
+@app.get("/metrics/collscans")
+async def metrics_collscans():
+    # queries that ran as collection scans since MIRRA_COLLSCAN_REPORT was set
+    return await collscan_report()
+
+client = AsyncMongoClient("mongodb://localhost:27017/")
 db = client["testdb"]
 
-class ConnectionManager:
+class MessageLog:
+    # the change log clients replay from - one record per broadcast event,
+    # numbered from an autoincrement counter. Ids are handed out from blocks
+    # reserved on the counter, so each worker only touches it once per block.
+    # An id is taken before its insert, so concurrent inserts can commit out of
+    # id order - ids handed out and not yet delivered are kept in unsent, and
+    # last_id() only goes as far as everything before it has been delivered.
+    #
+    # With several workers (shared), another worker's ids can be in flight
+    # too, and its blocks run behind or ahead of ours. Each worker publishes
+    # the lowest id it may still deliver in counters (messages_low:<worker>,
+    # None for nothing) and hears everyone else's through the change stream -
+    # after the messages that came before it, so a mark never gets ahead of
+    # what this worker has received. last_id() is the lowest of them, less one
+    def __init__(self, db, block: int = 1000, shared: bool = False, sync_every: float = 0.5, lease: float = 30.0):
+        self.messages = db["messages"]
+        self.counters = db["counters"]
+        self.block = block
+        self.next = 0
+        self.block_end = 0
+        # highest id this worker has written or been delivered
+        self.high: Optional[int] = None
+        self.unsent: set[int] = set()
+        self.reserving = asyncio.Lock()
+        self.shared = shared
+        self.worker = str(ObjectId())
+        # our mark is published every sync_every seconds if it moved, and at
+        # least every lease / 3 - one not heard of for lease seconds is a
+        # worker that's gone, and stops counting
+        self.sync_every = sync_every
+        self.lease = lease
+        self.published: Optional[int] = None
+        self.republish = 0.0
+        # other workers' marks, as (lowest id, expires)
+        self.lows: Dict[str, Tuple[int, float]] = {}
+        self.syncer: Optional[asyncio.Task] = None
+
+    async def ensure_indexes(self):
+        await self.messages.create_indexes([IndexModel([("id", 1)], unique=True)])
+
+    async def start(self):
+        # seed the high-water mark, and make sure the counter is past it in
+        # case counters was reset
+        last_msg = await self.messages.find_one(sort=[("id", -1)])
+        self.seen(last_msg["id"] if last_msg and "id" in last_msg else 0)
+        await self.counters.update_one({"_id": "messages"}, {"$max": {"seq": self.high}}, upsert=True)
+        if self.shared:
+            await self.load_lows()
+            self.syncer = asyncio.create_task(self._sync())
+
+    async def stop(self):
+        if self.syncer:
+            self.syncer.cancel()
+            try:
+                await self.syncer
+            except asyncio.CancelledError:
+                pass
+            self.syncer = None
+            # nothing more is coming from us - don't keep the others waiting a lease
+            async with self.reserving:
+                self.next = self.block_end + 1
+                await self._publish_low(min(self.unsent) if self.unsent else None)
+
+    def seen(self, msg_id: int):
+        self.high = max(self.high or 0, msg_id)
+
+    async def next_id(self) -> int:
+        async with self.reserving:
+            if self.next == 0 or self.next > self.block_end:
+                if self.shared and self.published is None:
+                    # tell the others before the ids exist - the block will be
+                    # past everything delivered so far
+                    await self._publish_low((self.high or 0) + 1)
+                counter = await self.counters.find_one_and_update(
+                    {"_id": "messages"},
+                    {"$inc": {"seq": self.block}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                self.block_end = counter["seq"]
+                self.next = self.block_end - self.block + 1
+            msg_id = self.next
+            self.next += 1
+            # (before the lock goes - a sync mustn't see it as neither unsent nor to come)
+            self.unsent.add(msg_id)
+        self.seen(msg_id)
+        return msg_id
+
+    def delivered(self, msg_id: int):
+        self.unsent.discard(msg_id)
+
+    def stable(self) -> int:
+        # every id this worker handed out up to here has been delivered, or never will be
+        return min(self.unsent) - 1 if self.unsent else self.high or 0
+
+    def low(self) -> Optional[int]:
+        # the lowest id this worker may still deliver - handed out and not yet
+        # delivered, or still to come from its block
+        lows = [min(self.unsent)] if self.unsent else []
+        if 0 < self.next <= self.block_end:
+            lows.append(self.next)
+        return min(lows) if lows else None
+
+    def low_water(self) -> int:
+        # every id up to here, from any worker, has been delivered here or never will be
+        now = time.monotonic()
+        lows = [low for low, expires in self.lows.values() if expires > now]
+        own = self.low()
+        if own is not None:
+            lows.append(own)
+        return min(lows) - 1 if lows else self.high or 0
+
+    def heard(self, worker: str, low: Optional[int]):
+        # another worker's mark, from the change stream
+        if worker == self.worker:
+            return
+        if low is None:
+            self.lows.pop(worker, None)
+        else:
+            self.lows[worker] = (low, time.monotonic() + self.lease)
+
+    async def load_lows(self):
+        # the marks published before the change stream was watching - they may
+        # have moved on since, which only holds last_id() back until we hear.
+        # Anything older than a lease is from a worker that's gone
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.lease)
+        async for doc in self.counters.find({"_id": {"$regex": "^messages_low:"}, "at": {"$gt": cutoff}}):
+            self.heard(doc["_id"].removeprefix("messages_low:"), doc.get("seq"))
+
+    async def _publish_low(self, low: Optional[int]):
+        # a replace, so the change stream carries the whole document - and at,
+        # so republishing the same mark is still a change
+        await self.counters.replace_one({"_id": f"messages_low:{self.worker}"},
+                                        {"seq": low, "at": datetime.now(timezone.utc)}, upsert=True)
+        self.published = low
+        self.republish = time.monotonic() + self.lease / 3
+
+    async def sync(self):
+        async with self.reserving:
+            if self.next and (self.high or 0) > self.block_end:
+                # others have gone past our block - the rest of it would hold
+                # everyone's last_id() back, so give it up
+                self.next = self.block_end + 1
+            low = self.low()
+            if low != self.published or time.monotonic() > self.republish:
+                await self._publish_low(low)
+
+    async def _sync(self):
+        while True:
+            await asyncio.sleep(self.sync_every)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("couldn't publish this worker's message id mark")
+
+    async def append(self, message: dict) -> dict:
+        msg = {**message, "id": await self.next_id()}
+        try:
+            # insert a copy - insert_one adds an ObjectId _id that can't go over
+            # the wire, and at is only for retention
+            await self.messages.insert_one({**msg, "at": datetime.now(timezone.utc)})
+        except BaseException:
+            self.unsent.discard(msg["id"])
+            raise
+        return msg
+
+    async def last_id(self) -> int:
+        if self.high is None:
+            await self.start()
+        return self.low_water()
+
+    async def since(self, last_id: int, limit: int = 0) -> List[dict]:
+        cursor = self.messages.find({"id": {"$gt": last_id}}, {"_id": 0, "at": 0}).sort("id", 1).limit(limit)
+        return await cursor.to_list()
+
+    # retention - trimming drops messages for good, so the floor is recorded
+    # first: a client that last saw an id below it has to resync. Compacting
+    # loses nothing, each item's changes end up in one message
+
+    async def floor(self) -> int:
+        counter = await self.counters.find_one({"_id": "messages_floor"})
+        return counter["seq"] if counter else 0
+
+    async def trim(self, floor: int) -> int:
+        await self.counters.update_one({"_id": "messages_floor"}, {"$max": {"seq": floor}}, upsert=True)
+        result = await self.messages.delete_many({"id": {"$lte": floor}})
+        return result.deleted_count
+
+    async def older_than(self, cutoff: datetime) -> int:
+        # the highest id that can go for a time horizon - walks the id index up
+        # from the oldest message, which the last trim left close to the cutoff
+        first = await self.messages.find_one({"at": {"$gte": cutoff}}, {"id": 1}, sort=[("id", 1)])
+        if first:
+            return first["id"] - 1
+        last = await self.messages.find_one({}, {"id": 1}, sort=[("id", -1)])
+        return last["id"] if last else 0
+
+    async def compact(self, upto: int, batch: int = 1000) -> Tuple[int, int]:
+        # on from where the last run got to, a batch at a time. The messages
+        # still holding an item's latest change are carried into the next
+        # batch (up to a batch of them), so an item changed all through the
+        # range still ends up in one message - one per run, at most, for
+        # all but the items that fall out of the carry
+        counter = await self.counters.find_one({"_id": "messages_compacted"})
+        after = counter["seq"] if counter else 0
+        carry: List[dict] = []
+        deleted = rewritten = 0
+        while after < upto:
+            cursor = self.messages.find({"id": {"$gt": after, "$lte": upto}}, {"_id": 0}).sort("id", 1).limit(batch)
+            messages = await cursor.to_list()
+            if not messages:
+                break
+            deletes, rewrites = compacted(carry + messages)
+            ops = [DeleteMany({"id": {"$in": deletes}})] if deletes else []
+            ops += [ReplaceOne({"id": msg["id"]}, msg) for msg in rewrites]
+            if ops:
+                await self.messages.bulk_write(ops, ordered=False)
+            gone, changed = set(deletes), {msg["id"]: msg for msg in rewrites}
+            carry = [changed.get(msg["id"], msg) for msg in carry + messages if msg["id"] not in gone][-batch:]
+            after = messages[-1]["id"]
+            await self.counters.update_one({"_id": "messages_compacted"}, {"$max": {"seq": after}}, upsert=True)
+            deleted += len(deletes)
+            rewritten += len(rewrites)
+        return deleted, rewritten
+
+
+class Retention:
+    # keeps the message log bounded: every `every` seconds, messages older
+    # than max_age seconds or further back than max_messages are trimmed, and
+    # everything further back than compact_window messages is compacted to one
+    # event per item. Not a TTL index or a capped collection - both drop
+    # messages without recording where, and replay has to know to send resync.
+    # With several workers, a lease in counters lets one of them run at a time
+    def __init__(self, log: MessageLog, max_age: Optional[float] = None, max_messages: Optional[int] = None,
+                 compact_window: Optional[int] = None, every: float = 60.0):
+        self.log = log
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.compact_window = compact_window
+        self.every = every
+        self.task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.trimmed = 0
+        self.compacted = 0
+        self.rewritten = 0
+        self.last_run = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_age or self.max_messages or self.compact_window)
+
+    async def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.every)
+            try:
+                if await self._lease():
+                    await self.run()
+            except Exception:
+                # try again next time round
+                logger.exception("message log retention failed")
+
+    async def _lease(self) -> bool:
+        now = time.time()
+        try:
+            await self.log.counters.find_one_and_update(
+                {"_id": "retention", "until": {"$lt": now}}, {"$set": {"until": now + self.every / 2}}, upsert=True)
+        except DuplicateKeyError:
+            # another worker holds it
+            return False
+        return True
+
+    async def run(self):
+        start = time.perf_counter()
+        last_id = await self.log.last_id()
+        floor = 0
+        if self.max_messages:
+            floor = max(floor, last_id - self.max_messages)
+        if self.max_age:
+            floor = max(floor, await self.log.older_than(datetime.now(timezone.utc) - timedelta(seconds=self.max_age)))
+        if floor > await self.log.floor():
+            self.trimmed += await self.log.trim(floor)
+        if self.compact_window and last_id - self.compact_window > floor:
+            deleted, rewritten = await self.log.compact(last_id - self.compact_window)
+            self.compacted += deleted
+            self.rewritten += rewritten
+        self.runs += 1
+        self.last_run = time.perf_counter() - start
+
+    def stats(self) -> dict:
+        return {
+            "max_age": self.max_age,
+            "max_messages": self.max_messages,
+            "compact_window": self.compact_window,
+            "runs": self.runs,
+            "trimmed": self.trimmed,
+            "compacted": self.compacted,
+            "rewritten": self.rewritten,
+            "last_run_ms": round(self.last_run * 1000, 3),
+        }
+
+
+class BroadcastBus:
+    # carries each persisted change message to the ConnectionManager (and
+    # anything else subscribed) of every worker, so a write handled by one
+    # process reaches sockets held by all of them. A bus that has lost
+    # changes delivers {"resync": True} instead
     def __init__(self):
-        self.active_connections: dict[WebSocket, bool] = {}
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def deliver(self, msg: dict):
+        for callback in self.subscribers:
+            # one subscriber failing mustn't keep the change from the rest -
+            # this runs in the writer's request, after the write is committed
+            try:
+                callback(msg)
+            except Exception:
+                logger.exception("bus subscriber %r failed on message %s", callback, msg.get("id"))
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, msg: dict):
+        raise NotImplementedError
+
+
+class LocalBus(BroadcastBus):
+    # in-process only - for a single worker, and for tests
+    async def publish(self, msg: dict):
+        self.deliver(msg)
+
+
+# mongod's error code for a resume token that's no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class ChangeStreamBus(BroadcastBus):
+    # every worker watches inserts into the messages collection, so each change
+    # is delivered once per worker whichever worker (or node) wrote it - and
+    # the other workers' marks in counters, in the same stream so they arrive
+    # in order with the messages. Change streams need mongod running as a
+    # replica set
+    def __init__(self, log: MessageLog, retry_delay: float = 1.0):
+        super().__init__()
+        self.log = log
+        self.collection = log.messages
+        self.retry_delay = retry_delay
+        self.resume_token = None
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def publish(self, msg: dict):
+        # nothing to do - the insert into messages is the publish
+        pass
+
+    async def _watch(self):
+        messages, counters = self.collection.name, self.log.counters.name
+        pipeline = [{"$match": {"$or": [
+            {"ns.coll": messages, "operationType": "insert"},
+            {"ns.coll": counters, "operationType": {"$in": ["insert", "replace"]},
+             "documentKey._id": {"$regex": "^messages_low:"}},
+        ]}}]
+        while True:
+            try:
+                # resume after the last change we delivered so a dropped stream
+                # neither skips nor repeats messages
+                async with await self.collection.database.watch(pipeline, resume_after=self.resume_token) as stream:
+                    async for change in stream:
+                        if change["ns"]["coll"] == messages:
+                            msg = change["fullDocument"]
+                            msg.pop("_id", None)
+                            msg.pop("at", None)
+                            self.deliver(msg)
+                        else:
+                            self.log.heard(change["documentKey"]["_id"].removeprefix("messages_low:"),
+                                           change["fullDocument"].get("seq"))
+                        self.resume_token = stream.resume_token
+            except PyMongoError as e:
+                if getattr(e, "code", None) == CHANGE_STREAM_HISTORY_LOST:
+                    # the resume point has fallen off the oplog, so retrying it
+                    # never works - start again from now, and have everyone
+                    # reload what this worker missed in between
+                    self.resume_token = None
+                    self.deliver({"resync": True})
+                    try:
+                        await self.log.load_lows()
+                    except PyMongoError:
+                        await asyncio.sleep(self.retry_delay)
+                else:
+                    await asyncio.sleep(self.retry_delay)
+
+
+class DocumentCache:
+    # serialized documents by (entity path, _id) for get_single_item, kept up
+    # to date from the change messages every worker receives - so when a write
+    # makes every connected browser reload the same item, it's served from memory
+    def __init__(self, max_items: int = 10000, ttl: float = 60.0):
+        self.max_items = max_items
+        self.ttl = ttl
+        # each entry is (expires, payload, validator headers)
+        self.entries: OrderedDict[tuple, tuple[float, bytes, dict]] = OrderedDict()
+        # one load per key at a time - concurrent misses wait for the same one
+        self.loading: dict[tuple, asyncio.Task] = {}
+        # bumped by every change, so a load that raced a change isn't stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.updates = 0
+        self.invalidations = 0
+
+    async def get(self, key: tuple, load) -> Optional[tuple[bytes, dict]]:
+        # (payload, validator headers) - load returns the same, or None
+        entry = self.entries.get(key)
+        if entry:
+            expires, payload, headers = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return payload, headers
+            del self.entries[key]
+            self.expirations += 1
+        task = self.loading.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, load))
+            self.loading[key] = task
+            task.add_done_callback(lambda _: self.loading.pop(key, None))
+        # shielded so one caller going away doesn't cancel the load for the rest
+        return await asyncio.shield(task)
+
+    async def _load(self, key: tuple, load) -> Optional[tuple[bytes, dict]]:
+        generation = self.generation
+        loaded = await load()
+        if loaded is not None and generation == self.generation:
+            self.put(key, *loaded)
+        return loaded
+
+    def put(self, key: tuple, payload: bytes, headers: dict):
+        self.entries[key] = (time.monotonic() + self.ttl, payload, headers)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def apply(self, msg: dict):
+        # bus subscriber - store the document each change carries, or apply its delta
+        self.generation += 1
+        if msg.get("resync"):
+            # changes were missed - nothing here can be trusted
+            self.entries.clear()
+            return
+        for change in msg.get("changes", [msg]):
+            key = change.get("key")
+            prefix = entity_type(change)
+            if change.get("data") is not None:
+                self.put((prefix, key), json_bytes(change["data"]), document_validators(change["data"]))
+                self.updates += 1
+                continue
+            # a patch can only be applied to the version it was made from
+            entry = self.entries.pop((prefix, key), None)
+            if entry and change.get("delta") is not None:
+                doc = json.loads(entry[1])
+                if (doc.get("_v") or 0) == change.get("base"):
+                    doc.update(change["delta"])
+                    self.put((prefix, key), json_bytes(doc), document_validators(doc))
+                    self.updates += 1
+
+    def invalidate(self, change: dict):
+        # forget an item whose change hasn't been broadcast yet
+        self.generation += 1
+        if self.entries.pop((entity_type(change), change.get("key")), None):
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "updates": self.updates,
+            "invalidations": self.invalidations,
+        }
+
+
+def entity_type(change: dict) -> str:
+    # "/persons/p1" -> "/persons", and a bulk message's entity is already the type
+    entity, key = change.get("entity", ""), change.get("key")
+    if key is not None and entity.endswith(f"/{key}"):
+        return entity[:-len(key) - 1]
+    return entity
+
+
+class TopicFilter:
+    # a filter subscription - equality on top-level fields. Patches only carry
+    # what changed, so it remembers which keys matched: a change that moves a
+    # document out of the filter still reaches the client once
+    def __init__(self, entity: str, filter: dict, keys: Optional[List[str]] = None):
+        self.entity = entity
+        self.filter = filter
+        self.keys = set(keys or [])
+
+    @staticmethod
+    def error(data: dict) -> Optional[str]:
+        # what's wrong with a subscribe / unsubscribe frame, if anything - it's
+        # matched against every change, so it has to be plain values
+        key, filter, keys = data.get("key"), data.get("filter"), data.get("keys")
+        if not isinstance(data.get("entity"), str):
+            return "needs an entity"
+        if key is not None and not isinstance(key, str):
+            return "key must be a string"
+        if filter is not None and not (isinstance(filter, dict) and all(
+                v is None or isinstance(v, (str, int, float, bool)) for v in filter.values())):
+            return "filter must be an object of field: value, with string, number, boolean or null values"
+        if keys is not None and not (isinstance(keys, list) and all(isinstance(k, str) for k in keys)):
+            return "keys must be a list of strings"
+        return None
+
+    def copy(self) -> "TopicFilter":
+        return TopicFilter(self.entity, self.filter, list(self.keys))
+
+    def wants(self, change: dict) -> bool:
+        key = change.get("key")
+        fields = change.get("data") or change.get("delta") or {}
+        carried = [f for f in self.filter if f in fields]
+        if any(fields[f] != self.filter[f] for f in carried):
+            if key in self.keys:
+                self.keys.discard(key)
+                return True
+            return False
+        if len(carried) == len(self.filter):
+            self.keys.add(key)
+            return True
+        return key in self.keys
+
+
+def coalesce(old: dict, new: dict) -> dict:
+    # two changes to the same item as one - patches merge their deltas onto the
+    # earlier base, and a delta on top of a whole document merges into it
+    if new.get("mode") == "patch":
+        if old.get("mode") == "patch":
+            return {**old, "delta": {**old["delta"], **new["delta"]}}
+        return {**old, "data": {**old["data"], **new["delta"]}}
+    if old.get("mode") == "create" and new.get("mode") == "update":
+        # it's still new to anyone hearing about it now
+        return {**new, "mode": "create"}
+    return new
+
+
+def bulk_message(changes: List[dict]) -> dict:
+    # changes as one message - across entity types, each change carries its own entity
+    types = {entity_type(c) for c in changes}
+    return {"entity": types.pop() if len(types) == 1 else "", "mode": "bulk", "changes": changes}
+
+
+def compacted(messages: List[dict]) -> Tuple[List[int], List[dict]]:
+    # messages (in id order) with each item's changes coalesced into the last
+    # message that touched it - the ids of messages left empty, and the
+    # messages that changed. Someone replaying from any id in between gets a
+    # document at least as new as the one they skipped, which is all they need
+    latest = {}
+    originals = {}
+    for msg in messages:
+        changes = [{k: v for k, v in c.items() if k not in ("id", "at")} for c in msg.get("changes") or [msg]]
+        originals[msg["id"]] = changes
+        for change in changes:
+            key = (entity_type(change), change.get("key"))
+            latest[key] = (coalesce(latest[key][0], change) if key in latest else change, msg["id"])
+    kept: Dict[int, List[dict]] = {}
+    for change, msg_id in latest.values():
+        kept.setdefault(msg_id, []).append(change)
+    deletes, rewrites = [], []
+    for msg in messages:
+        changes = kept.get(msg["id"])
+        if not changes:
+            deletes.append(msg["id"])
+        elif {id(c) for c in changes} != {id(c) for c in originals[msg["id"]]}:
+            rewritten = changes[0] if len(changes) == 1 else bulk_message(changes)
+            rewrites.append({**rewritten, "id": msg["id"], "at": msg.get("at")})
+    return deletes, rewrites
+
+
+class ClientConnection:
+    # one connected socket - everything sent to it goes through a bounded queue
+    # drained by its own writer task, so a slow client only ever holds up itself
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, max_queue: int, encoding: str = "json"):
+        self.manager = manager
+        self.websocket = websocket
+        # any frame from the client counts - pings only go to quiet sockets
+        self.last_seen = time.monotonic()
+        # (payload, future to resolve once it's written - or None)
+        self.queue: asyncio.Queue[Tuple[Union[str, bytes], Optional[asyncio.Future]]] = asyncio.Queue(max_queue)
+        self.waiting: set[asyncio.Future] = set()
+        # how messages go out on this socket - one of WIRE_ENCODINGS, agreed at connect
+        self.encoding = encoding
+        self.encode = WIRE_ENCODINGS[encoding]
+        self.bytes = 0
+        self.sent = 0
+        self.dropped = 0
+        # until its first subscribe a client gets everything, as it always did
+        self.subscribed = False
+        self.topics: set[str] = set()
+        self.filters: Dict[str, List[TopicFilter]] = {}
+        self.writer = asyncio.create_task(self._write())
+
+    def wants(self, change: dict, filters: Optional[Dict[str, List[TopicFilter]]] = None) -> bool:
+        if not self.subscribed:
+            return True
+        prefix = entity_type(change)
+        if prefix in self.topics or change.get("entity") in self.topics:
+            return True
+        # every filter sees the change, so they all keep their keys up to date
+        return any([f.wants(change) for f in (self.filters if filters is None else filters).get(prefix, [])])
+
+    def select(self, msg: dict, filters: Optional[Dict[str, List[TopicFilter]]] = None) -> Optional[dict]:
+        # the part of msg this client watches - all of it, the changes it
+        # watches out of a bulk message, or None. filters stands in for the
+        # live ones, for looking at changes that aren't live
+        if msg.get("mode") == "bulk":
+            if not self.subscribed or msg.get("entity") in self.topics:
+                return msg
+            changes = [c for c in msg["changes"] if self.wants(c, filters)]
+            return {**msg, "changes": changes} if changes else None
+        return msg if self.wants(msg, filters) else None
+
+    def push(self, payload: Union[str, bytes]) -> bool:
+        # non-blocking, for broadcasts - False when the queue is full
+        try:
+            self.queue.put_nowait((payload, None))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def send(self, payload: Union[str, bytes], wait: bool = False):
+        # waits for room in the queue, for direct replies to this client - and
+        # with wait, until this payload (not whatever is queued behind it) has
+        # gone out on the socket
+        written = asyncio.get_running_loop().create_future() if wait else None
+        if written:
+            self.waiting.add(written)
+        await self.queue.put((payload, written))
+        if written:
+            try:
+                await written
+            finally:
+                self.waiting.discard(written)
+
+    async def _write(self):
+        try:
+            while True:
+                payload, written = await self.queue.get()
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+                # text frames go out as UTF-8 - an ASCII str (which CPython knows
+                # without looking) is already as long as that
+                self.bytes += len(payload) if isinstance(payload, bytes) or payload.isascii() else len(payload.encode())
+                self.sent += 1
+                if written and not written.done():
+                    written.set_result(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.manager.disconnect(self.websocket)
+
+    def stop(self):
+        self.writer.cancel()
+        # nothing more is going out - don't leave anyone waiting for it
+        for written in self.waiting:
+            written.cancel()
+
+    async def close(self, code: int = 1000):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "sent": self.sent, "bytes": self.bytes, "encoding": self.encoding,
+                "dropped": self.dropped, "idle": round(time.monotonic() - self.last_seen, 1),
+                "topics": len(self.topics) + sum(len(f) for f in self.filters.values())}
+
+
+class Heartbeat:
+    # liveness for every socket without sweeping them all at once: sockets are
+    # dealt round-robin into buckets, and each tick (interval / buckets) looks
+    # at one bucket - so every socket is looked at once per interval and no
+    # tick does more than its share. A socket quiet for half the interval is
+    # pinged, and one quiet for timeout is closed. Pings are only queued here -
+    # each socket's writer sends its own, so they go out concurrently.
+    #
+    # ping="server" leaves pinging to the ASGI server's protocol-level ping
+    # and pong frames (uvicorn's --ws-ping-interval / --ws-ping-timeout), which
+    # browsers answer without any script - dead sockets then show up as
+    # disconnects instead, and this only keeps the metrics
+    def __init__(self, manager: "ConnectionManager", interval: float = 30.0, buckets: int = 30,
+                 timeout: Optional[float] = None, ping: str = "app"):
+        self.manager = manager
+        self.interval = interval
+        self.timeout = timeout or 2 * interval
+        self.ping = ping
+        self.buckets: List[set[WebSocket]] = [set() for _ in range(buckets)]
+        self.slots: Dict[WebSocket, int] = {}
+        self.next_slot = 0
+        self.tick = 0
+        self.task: Optional[asyncio.Task] = None
+        self.pings = 0
+        self.reaped = 0
+        self.tick_time = 0.0
+        self.max_tick_time = 0.0
+        self.sweep_time = 0.0
+        self.last_sweep = 0.0
+
+    def add(self, websocket: WebSocket):
+        self.slots[websocket] = self.next_slot
+        self.buckets[self.next_slot].add(websocket)
+        self.next_slot = (self.next_slot + 1) % len(self.buckets)
+
+    def remove(self, websocket: WebSocket):
+        slot = self.slots.pop(websocket, None)
+        if slot is not None:
+            self.buckets[slot].discard(websocket)
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        step = self.interval / len(self.buckets)
+        while True:
+            await asyncio.sleep(step)
+            self.beat()
+
+    def beat(self):
+        # one tick - the next bucket
+        start = time.perf_counter()
+        now = time.monotonic()
+        payloads = {}
+        for websocket in list(self.buckets[self.tick]):
+            connection = self.manager.active_connections.get(websocket)
+            if not connection:
+                self.remove(websocket)
+                continue
+            idle = now - connection.last_seen
+            if self.ping != "app":
+                continue
+            if idle > self.timeout:
+                self.reaped += 1
+                self.manager.kick(websocket)
+            elif idle >= self.interval / 2:
+                if connection.encoding not in payloads:
+                    payloads[connection.encoding] = connection.encode({"type": "ping"})
+                connection.push(payloads[connection.encoding])
+                self.pings += 1
+        elapsed = time.perf_counter() - start
+        self.tick_time = elapsed
+        self.max_tick_time = max(self.max_tick_time, elapsed)
+        self.sweep_time += elapsed
+        self.tick = (self.tick + 1) % len(self.buckets)
+        if self.tick == 0:
+            # all buckets done - that's one sweep
+            self.last_sweep, self.sweep_time = self.sweep_time, 0.0
+
+    def stats(self) -> dict:
+        return {
+            "ping": self.ping,
+            "interval": self.interval,
+            "buckets": len(self.buckets),
+            "pings": self.pings,
+            "reaped": self.reaped,
+            # CPU time, in ms - per tick, and for the last full pass over every socket
+            "tick_ms": round(self.tick_time * 1000, 3),
+            "max_tick_ms": round(self.max_tick_time * 1000, 3),
+            "sweep_ms": round(self.last_sweep * 1000, 3),
+        }
+
+
+class ConnectionManager:
+    def __init__(self, log: MessageLog, bus: BroadcastBus, max_queue: int = 256, overflow: str = "disconnect",
+                 replay_batch: int = 500, replay_horizon: int = 10000, coalesce: float = 0.0,
+                 ping_interval: float = 30.0, ping: str = "app", cache: Optional[DocumentCache] = None):
+        self.log = log
+        self.bus = bus
+        # this worker's document cache, to forget items whose changes are held back
+        self.cache = cache
+        self.bus.subscribe(self.deliver)
+        self.max_queue = max_queue
+        # messagesSince streams at most replay_batch messages per frame, and asks
+        # clients more than replay_horizon messages behind to resync instead
+        self.replay_batch = replay_batch
+        self.replay_horizon = replay_horizon
+        # what to do with a client whose queue is full: "disconnect" closes it so it
+        # reconnects and replays with messagesSince, "drop" just skips the frame
+        self.overflow = overflow
+        # changes are held for coalesce seconds - several changes to one item
+        # become one, and everything in the window goes out as one message
+        # (one log entry, one frame). 0 sends each change as it's made
+        self.coalesce = coalesce
+        self.pending: Dict[tuple, dict] = {}
+        self.flusher: Optional[asyncio.Task] = None
+        self.changes = 0
+        self.events = 0
+        self.frames = 0
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+        self.heartbeat = Heartbeat(self, ping_interval, ping=ping)
+        # topic index - who to even look at for a change: clients that never
+        # subscribed, clients watching the entity type or the single item, and
+        # clients with filters on the type
+        self.firehose: set[WebSocket] = set()
+        self.topics: Dict[str, set[WebSocket]] = {}
+        self.filtered: Dict[str, set[WebSocket]] = {}
+        self.dropped = 0
+        self.overflowed = 0
+        self.skipped = 0
+        # delivered messages waiting for lower ids, as (id, message)
+        self.held: List[Tuple[int, dict]] = []
 
     async def connect(self, websocket: WebSocket):
-        await websocket.accept()
+        # the client offers encodings as subprotocols, in the order it prefers
+        # them - one that offers none gets JSON text frames, as it always did
+        offered = websocket.scope.get("subprotocols") or []
+        subprotocol = next((p for p in offered if p.removeprefix("mirra.") in WIRE_ENCODINGS), None)
+        encoding = subprotocol.removeprefix("mirra.") if subprotocol else "json"
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(self, websocket, self.max_queue, encoding)
         # Send the highest message id to the client
-        last_msg = db["messages"].find_one(sort=[("id", -1)])
-        last_id = last_msg["id"] if last_msg and "id" in last_msg else 0
-        await websocket.send_json({"message": { "last_message_id": last_id } })
-        self.active_connections[websocket] = True
+        last_id = await self.log.last_id()
+        await connection.send(connection.encode({"message": { "last_message_id": last_id } }))
+        self.active_connections[websocket] = connection
+        self.firehose.add(websocket)
+        self.heartbeat.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            del self.active_connections[websocket]
+        connection = self.active_connections.pop(websocket, None)
+        if connection:
+            self._unindex(websocket, connection)
+            connection.stop()
+
+    def kick(self, websocket: WebSocket, code: int = 1000):
+        connection = self.active_connections.pop(websocket, None)
+        if connection:
+            self._unindex(websocket, connection)
+            asyncio.create_task(connection.close(code))
+
+    def subscribe(self, websocket: WebSocket, entity: str, key: Optional[str] = None,
+                  filter: Optional[dict] = None, keys: Optional[List[str]] = None):
+        # a whole entity type ("/persons"), one item (key="p1") or the items
+        # matching filter - keys are the ones the client already holds
+        connection = self.active_connections.get(websocket)
+        if not connection:
+            return
+        if not connection.subscribed:
+            connection.subscribed = True
+            self.firehose.discard(websocket)
+        if filter:
+            connection.filters.setdefault(entity, []).append(TopicFilter(entity, filter, keys))
+            self.filtered.setdefault(entity, set()).add(websocket)
+        else:
+            topic = f"{entity}/{key}" if key is not None else entity
+            connection.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, entity: str, key: Optional[str] = None, filter: Optional[dict] = None):
+        connection = self.active_connections.get(websocket)
+        if not connection:
+            return
+        if filter:
+            filters = [f for f in connection.filters.get(entity, []) if f.filter != filter]
+            if filters:
+                connection.filters[entity] = filters
+            else:
+                connection.filters.pop(entity, None)
+                self._discard(self.filtered, entity, websocket)
+        else:
+            topic = f"{entity}/{key}" if key is not None else entity
+            connection.topics.discard(topic)
+            self._discard(self.topics, topic, websocket)
+
+    def _discard(self, index: Dict[str, set], topic: str, websocket: WebSocket):
+        sockets = index.get(topic)
+        if sockets:
+            sockets.discard(websocket)
+            if not sockets:
+                del index[topic]
+
+    def seen(self, websocket: WebSocket):
+        connection = self.active_connections.get(websocket)
+        if connection:
+            connection.last_seen = time.monotonic()
+
+    def _unindex(self, websocket: WebSocket, connection: ClientConnection):
+        self.heartbeat.remove(websocket)
+        self.firehose.discard(websocket)
+        for topic in connection.topics:
+            self._discard(self.topics, topic, websocket)
+        for entity in connection.filters:
+            self._discard(self.filtered, entity, websocket)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        connection = self.active_connections.get(websocket)
+        if connection:
+            await connection.send(connection.encode(message))
+
+    async def replay(self, websocket: WebSocket, last_id: int):
+        # sends {"messages": [...], "last_id": n} batches in id order, then
+        # {"replay": "end", "last_id": n}. A client that drops mid-replay resumes
+        # by asking again from the last_id of the last batch it applied. Every
+        # message past the client's id is sent, but last_id never goes past the
+        # low-water mark - a lower id still to come reaches the client live, and
+        # is replayed the next time if it doesn't
+        connection = self.active_connections.get(websocket)
+        if not connection:
+            return
+        latest = await self.log.last_id()
+        if self.log.high - last_id > self.replay_horizon or last_id < await self.log.floor():
+            await connection.send(connection.encode({"resync": True, "last_message_id": latest}))
+            return
+        # history is matched against copies of the client's filters - replaying
+        # an item out of a filter mustn't change what it gets live. Items it
+        # brings in are the client's now, so the live filters learn those
+        copies = [(live, live.copy(), set(live.keys)) for fs in connection.filters.values() for live in fs]
+        filters: Dict[str, List[TopicFilter]] = {}
+        for live, copy, _ in copies:
+            filters.setdefault(live.entity, []).append(copy)
+        after = last_id
+        while True:
+            messages = await self.log.since(after, self.replay_batch)
+            if not messages:
+                break
+            after = messages[-1]["id"]
+            last_id = max(last_id, min(after, self.log.low_water()))
+            # only what the client watches - last_id still moves past the rest
+            selected = [m for m in (connection.select(m, filters) for m in messages) if m]
+            for live, copy, held in copies:
+                live.keys |= copy.keys - held
+            # only one batch per client in memory at a time - and a client that
+            # is reading the replay is alive even if its pong is stuck behind it
+            await connection.send(connection.encode({"messages": selected, "last_id": last_id}), wait=True)
+            connection.last_seen = time.monotonic()
+            if len(messages) < self.replay_batch:
+                break
+        await connection.send(connection.encode({"replay": "end", "last_id": max(last_id, self.log.low_water())}))
 
     async def send_json(self, message: dict):
-        to_remove = []
-        for websocket in self.active_connections:
+        changes = message.get("changes") or [message]
+        self.changes += len(changes)
+        if not self.coalesce:
+            self.events += len(changes)
+            await self._publish(message)
+            return
+        for change in changes:
+            # reads mustn't see the old document until the window closes
+            if self.cache:
+                self.cache.invalidate(change)
+            self._hold(change)
+        if not self.flusher:
+            self.flusher = asyncio.create_task(self._flush_later(self.coalesce))
+
+    def _hold(self, change: dict):
+        key = (entity_type(change), change.get("key"))
+        self.pending[key] = coalesce(self.pending[key], change) if key in self.pending else change
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self.flusher = None
+        try:
+            await self.flush()
+        except Exception:
+            # flush() held the changes again - give the database a moment
+            logger.exception("couldn't send %d coalesced changes, trying again", len(self.pending))
+            if not self.flusher:
+                self.flusher = asyncio.create_task(self._flush_later(max(delay, 1.0)))
+
+    async def flush(self):
+        # sends whatever is waiting in the coalescing window
+        changes = list(self.pending.values())
+        self.pending = {}
+        if not changes:
+            return
+        try:
+            await self._publish(changes[0] if len(changes) == 1 else bulk_message(changes))
+        except BaseException:
+            # held again, under anything that came in meanwhile
+            newer, self.pending = self.pending, {}
+            for change in [*changes, *newer.values()]:
+                self._hold(change)
+            raise
+        self.events += len(changes)
+
+    async def _publish(self, message: dict):
+        # persist once with a single id, then hand it to the bus - every worker,
+        # this one included, gets it back through deliver()
+        self.frames += 1
+        try:
+            msg = await self.log.append(message)
+        except BaseException:
+            # its id won't be delivered now - later ones needn't wait for it
+            self.release()
+            raise
+        await self.bus.publish(msg)
+
+    def deliver(self, msg: dict):
+        if msg.get("resync"):
+            # the bus lost changes, ours among them - every client has to reload
+            self.log.unsent.clear()
+            self.release()
+            self.broadcast({websocket: connection.encode({"resync": True, "last_message_id": self.log.high})
+                            for websocket, connection in self.active_connections.items()})
+            return
+        self.log.seen(msg["id"])
+        self.log.delivered(msg["id"])
+        # in id order - a message waits for any lower id this worker handed out,
+        # so changes made here reach clients in the order they were made
+        heapq.heappush(self.held, (msg["id"], msg))
+        self.release()
+
+    def release(self):
+        stable = self.log.stable()
+        while self.held and self.held[0][0] <= stable:
+            msg = heapq.heappop(self.held)[1]
+            # clients keep last_id, not the id, as where to replay from
+            self.fan_out({**msg, "last_id": self.log.low_water()})
+
+    def fan_out(self, msg: dict):
+        # encode once per encoding, then queue the same payload for everyone who
+        # gets the whole message - only clients getting part of a bulk message cost more
+        payloads = {}
+        recipients = {}
+        for websocket in self.recipients(msg):
+            connection = self.active_connections.get(websocket)
+            # one socket that can't take the message mustn't keep it from the rest
             try:
-                await websocket.send_json(message)
-                # Save message to db with autoincrement id
-                msg = message.copy()
-                # Get next autoincrement id
-                counter = db["counters"].find_one_and_update(
-                    {"_id": "messages"},
-                    {"$inc": {"seq": 1}},
-                    upsert=True,
-                    return_document=True
-                )
-                msg_id = counter["seq"]
-                msg["id"] = msg_id
-                db["messages"].insert_one(msg)
-            except:
-                to_remove.append(websocket)
-        for ws in to_remove:
-            self.disconnect(ws)
-
-    async def ping_clients(self):
-        to_remove = []
-        for websocket, is_alive in self.active_connections.items():
-            if not is_alive:
-                to_remove.append(websocket)
-            else:
-                self.active_connections[websocket] = False
-                try:
-                    await websocket.send_json({"type": "ping"})
-                except:
-                    to_remove.append(websocket)
-        for ws in to_remove:
-            self.disconnect(ws)
+                selected = connection.select(msg) if connection else None
+                if selected is msg:
+                    if connection.encoding not in payloads:
+                        payloads[connection.encoding] = connection.encode(msg)
+                    recipients[websocket] = payloads[connection.encoding]
+                elif selected:
+                    recipients[websocket] = connection.encode(selected)
+            except Exception:
+                logger.exception("couldn't send message %s to a websocket", msg.get("id"))
+                # 1011 = internal error - it reconnects and subscribes again
+                self.kick(websocket, 1011)
+        self.skipped += len(self.active_connections) - len(recipients)
+        self.broadcast(recipients)
+
+    def recipients(self, msg: dict) -> set:
+        # candidates from the topic index - select() has the final say
+        sockets = set(self.firehose)
+        for change in msg.get("changes") or [msg]:
+            prefix = entity_type(change)
+            sockets |= self.topics.get(prefix, set())
+            sockets |= self.filtered.get(prefix, set())
+            sockets |= self.topics.get(change.get("entity"), set())
+        return sockets
+
+    def broadcast(self, payloads: Dict[WebSocket, Union[str, bytes]]):
+        for websocket, payload in payloads.items():
+            connection = self.active_connections.get(websocket)
+            if connection and not connection.push(payload):
+                self.dropped += 1
+                if self.overflow == "disconnect":
+                    self.overflowed += 1
+                    # 1013 = try again later
+                    self.kick(websocket, 1013)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.active_connections),
+            "queued": sum(c.queue.qsize() for c in self.active_connections.values()),
+            "bytes": sum(c.bytes for c in self.active_connections.values()),
+            "dropped": self.dropped,
+            "overflowed": self.overflowed,
+            "skipped": self.skipped,
+            "topics": len(self.topics) + len(self.filtered),
+            "coalescing": {
+                "window": self.coalesce,
+                "pending": len(self.pending),
+                "changes": self.changes,
+                "events": self.events,
+                "frames": self.frames,
+                # changes made per event sent, and per message logged
+                "ratio": round(self.changes / self.events, 2) if self.events else 1.0,
+                "batching": round(self.changes / self.frames, 2) if self.frames else 1.0,
+            },
+            "heartbeat": self.heartbeat.stats(),
+            "clients": [c.stats() for c in self.active_connections.values()],
+        }
+
+# MIRRA_BUS=changestream is needed to run with more than one worker (or node).
+# Each worker's ids come from its own block, so messages from different
+# workers arrive out of id order - clients are told the low-water mark with
+# every message, and keep that rather than the id: a reconnect replays from
+# below anything another worker may still deliver
+if os.environ.get("MIRRA_BUS") == "changestream":
+    log = MessageLog(db, shared=True)
+    bus = ChangeStreamBus(log)
+else:
+    bus = LocalBus()
+    log = MessageLog(db)
+
+# MIRRA_COALESCE_MS holds changes for that long, merging changes to the same
+# item - fewer frames and log entries under bursty edits, at that much latency
+# MIRRA_RETAIN_SECONDS / MIRRA_RETAIN_MESSAGES trim the message log by age and
+# count, and MIRRA_COMPACT_WINDOW compacts everything older than that many
+# messages to one event per item - all off unless set
+retention = Retention(
+    log,
+    max_age=float(os.environ.get("MIRRA_RETAIN_SECONDS", 0)) or None,
+    max_messages=int(os.environ.get("MIRRA_RETAIN_MESSAGES", 0)) or None,
+    compact_window=int(os.environ.get("MIRRA_COMPACT_WINDOW", 0)) or None,
+)
 
-manager = ConnectionManager()
+# MIRRA_PING=server leaves liveness to the ASGI server's protocol-level pings
+cache = DocumentCache()
+manager = ConnectionManager(log, bus, coalesce=float(os.environ.get("MIRRA_COALESCE_MS", 0)) / 1000,
+                            ping=os.environ.get("MIRRA_PING", "app"), cache=cache)
+bus.subscribe(cache.apply)
 
 # @app.on_event("startup")
 # async def start_ping():
@@ -151,25 +1329,123 @@ async def websocket_endpoint(websocket: WebSocket):
     try:
         while True:
             data = await websocket.receive_json()
+            manager.seen(websocket)
             a = data.get("action")
             
             if a == "pong":
-                manager.active_connections[websocket] = True
+                # seen() is all a pong needs
+                pass
+
+            elif a in ("subscribe", "unsubscribe"):
+                error = TopicFilter.error(data)
+                if error:
+                    await manager.send(websocket, {"error": f"{a} {error}"})
+                elif a == "subscribe":
+                    manager.subscribe(websocket, data["entity"], data.get("key"), data.get("filter"), data.get("keys"))
+                else:
+                    manager.unsubscribe(websocket, data["entity"], data.get("key"), data.get("filter"))
 
             elif a == "messagesSince":
                 try:
-                    last_id = data.get("last_id", 0)
-                    # Find all messages with id > last_id
-                    messages = list(db["messages"].find({"id": {"$gt": last_id}}, {"_id": 0}))
-                    await websocket.send_json({"messages": messages})
+                    await manager.replay(websocket, data.get("last_id", 0))
                 except Exception as e:
-                    await websocket.send_json({"error": str(e)})
+                    await manager.send(websocket, {"error": str(e)})
                 
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
 
+def bson_default(v):
+    if isinstance(v, ObjectId):
+        return str(v)
+    if isinstance(v, datetime):
+        return v.isoformat()
+    raise TypeError(f"{type(v).__name__} is not JSON serializable")
+
+def json_bytes(obj) -> bytes:
+    # orjson when it's installed, otherwise the standard library
+    if orjson:
+        return orjson.dumps(obj, default=bson_default)
+    return json.dumps(obj, default=bson_default, separators=(",", ":")).encode()
+
+# conditional GETs - weak ETags from the server version _v (and _t, for
+# documents written before there was one), so checking one costs nothing like
+# serializing the document. Lists hash the version of every document on the
+# page with the query. Last-Modified comes from _t; no-cache makes browsers
+# revalidate instead of guessing a freshness time from it
+
+def document_validators(doc: dict, variant: str = "") -> Dict[str, str]:
+    tag = f"{doc.get('_v') or 0}.{doc.get('_t') or 0}"
+    if variant:
+        tag += f".{zlib.crc32(variant.encode()):08x}"
+    return last_modified([doc], {"ETag": f'W/"{tag}"', "Cache-Control": "no-cache"})
+
+def list_validators(docs: List[dict], variant: str) -> Dict[str, str]:
+    versions = "\n".join([f"{doc.get('_id')}:{doc.get('_v')}:{doc.get('_t')}" for doc in docs])
+    digest = hashlib.blake2b(f"{variant}\n{versions}".encode(), digest_size=12).hexdigest()
+    return last_modified(docs, {"ETag": f'W/"{digest}"', "Cache-Control": "no-cache"})
+
+def last_modified(docs: List[dict], headers: Dict[str, str]) -> Dict[str, str]:
+    times = [doc["_t"] for doc in docs if isinstance(doc.get("_t"), (int, float))]
+    if times:
+        # _t is in milliseconds
+        headers["Last-Modified"] = formatdate(max(times) / 1000, usegmt=True)
+    return headers
+
+def not_modified(request: Request, headers: Dict[str, str]) -> bool:
+    # If-None-Match against our ETag - weak comparison, as GETs allow
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in header.split(",")}
+    return "*" in tags or headers["ETag"].removeprefix("W/") in tags
+
+# websocket frame encodings, offered by clients as "mirra.<name>" subprotocols.
+# permessage-deflate needs nothing here - the server negotiates it with the
+# browser on its own (uvicorn's --ws-per-message-deflate, on by default) and it
+# works with either encoding
+WIRE_ENCODINGS = {"json": lambda msg: json_bytes(msg).decode()}
+if msgpack:
+    WIRE_ENCODINGS["msgpack"] = lambda msg: msgpack.packb(msg, default=bson_default)
+
+async def gzip_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # flushes after every chunk so the client gets bytes as soon as they're ready
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+# filter operators by field type - anything else (lists, dicts, models) can't be filtered on
+ORDERED_OPERATORS = ("eq", "in", "gt", "gte", "lt", "lte")
+FILTER_OPERATORS = {
+    bool: ("eq",),
+    int: ORDERED_OPERATORS,
+    float: ORDERED_OPERATORS,
+    datetime: ORDERED_OPERATORS,
+    str: ORDERED_OPERATORS + ("prefix",),
+}
+
+def filter_type(type_hint):
+    # the plain type under Annotated[...] and Optional[...]
+    while True:
+        if get_origin(type_hint) is Annotated:
+            type_hint = get_args(type_hint)[0]
+            continue
+        args = [a for a in get_args(type_hint) if a is not type(None)]
+        if get_origin(type_hint) in (Union, UnionType) and len(args) == 1:
+            type_hint = args[0]
+            continue
+        return type_hint
+
+def field_value(doc: dict, field: str):
+    # value of a possibly dotted field name
+    for part in field.split("."):
+        doc = doc.get(part) if isinstance(doc, dict) else None
+    return doc
+
 def str_objectid(v):
     return str(v) if isinstance(v, ObjectId) else v
 
@@ -180,6 +1456,8 @@ class MirraModel(BaseModel):
     t_: Optional[int] = Field(default=None, alias="_t")
     u_: Optional[str] = Field(default=None, alias="_u")
     x_: Optional[bool] = Field(default=None, alias="_x")
+    # server-side version, bumped on every write
+    v_: Optional[int] = Field(default=None, alias="_v")
 
     model_config = ConfigDict(
         populate_by_name=True,
@@ -187,147 +1465,674 @@ class MirraModel(BaseModel):
         from_attributes=True,
     )
 
+    # indexes for the model's collection - subclasses declare their own and
+    # inherit these, which every list query (_x, paged by _id) and sync (_t) relies on
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("_x", 1), ("_id", 1)]),
+        IndexModel([("_t", 1)]),
+    ]
+
+    @classmethod
+    def all_indexes(cls) -> List[IndexModel]:
+        indexes = []
+        for c in reversed(cls.__mro__):
+            indexes.extend(vars(c).get("indexes", []))
+        return indexes
 
 
-from fastapi import APIRouter, HTTPException, Query, Depends
-from typing import Type, TypeVar, List, Dict, Any, Optional
-from pydantic import BaseModel, create_model
-from pymongo.collection import Collection
+
+from fastapi import APIRouter, HTTPException, Query, Depends, Body, Response
+from typing import Type, TypeVar, List, Dict, Any, Optional, AsyncIterator, Tuple
+from pydantic import BaseModel, TypeAdapter, ValidationError, create_model
 
 T = TypeVar("T", bound=BaseModel)
 
+
+class MirraRepository:
+    # storage interface the CRUD routers talk to - every method is async so a
+    # slow backend only holds up the request that is waiting on it.
+    # Every write sets or bumps the document's _v version
+    async def insert(self, doc: dict) -> dict:
+        raise NotImplementedError
+
+    async def get(self, item_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+        raise NotImplementedError
+
+    def find(self, query: dict, sort: Optional[List[tuple]] = None, skip: int = 0, limit: int = 0, batch_size: int = 0,
+             projection: Optional[dict] = None) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def update(self, item_id: str, doc: dict) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def patch(self, item_id: str, doc: dict) -> Optional[Tuple[dict, dict]]:
+        # like update, but returns the document before and after, to diff
+        raise NotImplementedError
+
+    async def delete(self, item_id: str) -> Optional[dict]:
+        # soft delete - flags the document with _x so it can be recovered / undone
+        raise NotImplementedError
+
+    async def insert_many(self, docs: List[dict]) -> List[Optional[str]]:
+        # one error message (or None) per doc, in order
+        raise NotImplementedError
+
+    async def update_many(self, docs: Dict[str, dict]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+        # updated documents by id - ids that didn't match are left out - and
+        # an error message by id for those that failed
+        raise NotImplementedError
+
+    async def delete_many(self, ids: List[str]) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    async def ensure_indexes(self, indexes: List[IndexModel]):
+        pass
+
+
+def versioned(doc: dict) -> dict:
+    # $set the fields and bump _v - the version is the repository's, not the client's
+    doc.pop("_v", None)
+    return {"$set": doc, "$inc": {"_v": 1}}
+
+
+class MongoRepository(MirraRepository):
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def ensure_indexes(self, indexes: List[IndexModel]):
+        if indexes:
+            await self.collection.create_indexes(indexes)
+
+    async def insert(self, doc: dict) -> dict:
+        # insert_one fills in _id on doc, so doc is what was stored
+        doc["_v"] = 1
+        await self.collection.insert_one(doc)
+        return doc
+
+    async def get(self, item_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+        return await self.collection.find_one({"_id": item_id}, projection)
+
+    async def find(self, query: dict, sort: Optional[List[tuple]] = None, skip: int = 0, limit: int = 0, batch_size: int = 0,
+                   projection: Optional[dict] = None) -> AsyncIterator[dict]:
+        cursor = self.collection.find(query, projection).skip(skip).limit(limit).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for doc in cursor:
+            yield doc
+
+    async def update(self, item_id: str, doc: dict) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": item_id},
+            versioned(doc),
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def patch(self, item_id: str, doc: dict) -> Optional[Tuple[dict, dict]]:
+        before = await self.collection.find_one_and_update(
+            {"_id": item_id},
+            versioned(doc),
+            return_document=ReturnDocument.BEFORE
+        )
+        if not before:
+            return None
+        # $set of top-level fields, so the result is just the two merged
+        return before, {**before, **doc, "_v": before.get("_v", 0) + 1}
+
+    async def delete(self, item_id: str) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            {"_id": item_id},
+            versioned({"_x": True}),
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def insert_many(self, docs: List[dict]) -> List[Optional[str]]:
+        errors: List[Optional[str]] = [None] * len(docs)
+        for doc in docs:
+            doc["_v"] = 1
+        try:
+            await self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                errors[error["index"]] = "duplicate" if error["code"] == 11000 else error["errmsg"]
+        return errors
+
+    async def update_many(self, docs: Dict[str, dict]) -> Tuple[Dict[str, dict], Dict[str, str]]:
+        # bulk_write doesn't hand back documents, so read them all back in one go
+        ids = list(docs)
+        errors = {}
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne({"_id": item_id}, versioned(doc)) for item_id, doc in docs.items()],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                errors[ids[error["index"]]] = "duplicate" if error["code"] == 11000 else error["errmsg"]
+        updated = await self._find_ids([i for i in ids if i not in errors])
+        return updated, errors
+
+    async def delete_many(self, ids: List[str]) -> Dict[str, dict]:
+        await self.collection.update_many({"_id": {"$in": ids}}, versioned({"_x": True}))
+        return await self._find_ids(ids)
+
+    async def _find_ids(self, ids: List[str]) -> Dict[str, dict]:
+        return {doc["_id"]: doc async for doc in self.collection.find({"_id": {"$in": ids}})}
+
+
 class CRUDRouterFactory:
-    def __init__(self, model: Type[T], collection: Collection, entity_name: str):
+    # every factory created, so startup can ensure all their indexes
+    factories: List["CRUDRouterFactory"] = []
+
+    def __init__(self, model: Type[T], repository: MirraRepository, entity_name: str, bulk_limit: int = 1000,
+                 export_batch: int = 1000, trusted_reads: bool = True, deltas: bool = True):
         self.model = model
-        self.collection = collection
+        self.repository = repository
         self.entity_name = entity_name
+        # most items accepted by one bulk request
+        self.bulk_limit = bulk_limit
+        # documents per cursor batch, and per chunk written, when exporting
+        self.export_batch = export_batch
+        # reads skip Model validation and go straight from the stored document to
+        # JSON - documents only ever get into the collection through the model
+        self.trusted_reads = trusted_reads
+        self._defaults = {
+            field.alias or name: field.get_default(call_default_factory=True)
+            for name, field in model.model_fields.items()
+            if not field.is_required()
+        }
+        # updates broadcast just the changed fields and the version they apply
+        # to ("patch"), rather than the whole document ("update")
+        self.deltas = deltas
+        # for validating PATCH bodies field by field
+        self._adapters = {
+            field.alias or name: TypeAdapter(field.annotation)
+            for name, field in model.model_fields.items()
+        }
+        CRUDRouterFactory.factories.append(self)
+
+    async def ensure_indexes(self):
+        await self.repository.ensure_indexes(self.model.all_indexes())
 
     def get_router(self, route_prefix: str = "") -> APIRouter:
         router = APIRouter()
         Model = self.model
-        collection = self.collection
+        repository = self.repository
         entity_name = self.entity_name
+        filter_query = self._build_filter_query()
+
+        # bulk routes go first so "bulk" isn't taken for an item_id.
+        # Each returns one {"_id", "status"} per item, in order, and sends one
+        # "bulk" broadcast holding the individual create/update/delete changes
+
+        @router.post(f"{route_prefix}/bulk")
+        async def create_items(items: List[Dict[str, Any]] = Body(...)):
+            results, docs = self._validate_batch(items)
+            valid = [(i, doc) for i, doc in enumerate(docs) if doc is not None]
+            errors = await repository.insert_many([doc for _, doc in valid]) if valid else []
+            changes = []
+            for (i, doc), error in zip(valid, errors):
+                if error:
+                    results[i] = {"_id": doc.get("_id"), "status": "error", "detail": error}
+                    continue
+                item = Model.model_validate(doc)
+                results[i] = {"_id": item.id, "status": "created"}
+                changes.append({
+                    "entity": f"{route_prefix}",
+                    "mode": "create",
+                    "key": item.id,
+                    "data": item.model_dump(by_alias=True)
+                })
+            await self._send_bulk(route_prefix, changes)
+            return results
+
+        @router.put(f"{route_prefix}/bulk")
+        async def update_items(items: List[Dict[str, Any]] = Body(...)):
+            results, docs = self._validate_batch(items)
+            updates = {}
+            for i, doc in enumerate(docs):
+                if doc is None:
+                    continue
+                if not doc.get("_id"):
+                    results[i] = {"_id": None, "status": "invalid", "detail": "_id is required"}
+                elif doc["_id"] in updates:
+                    # the first one for an id is written, so later ones can't be
+                    results[i] = {"_id": doc["_id"], "status": "invalid", "detail": "_id appears more than once"}
+                else:
+                    updates[doc["_id"]] = doc
+            updated, errors = await repository.update_many(updates) if updates else ({}, {})
+            await self._send_changes(route_prefix, "update", results, docs, updated, errors)
+            return results
+
+        @router.delete(f"{route_prefix}/bulk")
+        async def delete_items(ids: List[str] = Body(...)):
+            self._check_batch(ids)
+            results: List[Optional[dict]] = [None] * len(ids)
+            docs: List[Optional[dict]] = [None] * len(ids)
+            unique = {}
+            for i, item_id in enumerate(ids):
+                if item_id in unique:
+                    # as with PUT, only the first one for an id is reported and broadcast
+                    results[i] = {"_id": item_id, "status": "invalid", "detail": "_id appears more than once"}
+                else:
+                    docs[i] = unique[item_id] = {"_id": item_id}
+            deleted = await repository.delete_many(list(unique)) if unique else {}
+            await self._send_changes(route_prefix, "delete", results, docs, deleted)
+            return results
+
+        @router.get(f"{route_prefix}/export")
+        async def export_items(
+            deleted: bool = False,
+            sort: Optional[str] = Query(None, description="Comma-separated list of fields. Prefix with '-' for descending."),
+            compress: bool = Query(False, description="gzip the stream"),
+            fields: Optional[str] = Query(None, description="Comma-separated list of fields to return. _id is always included."),
+            filters: Dict[str, Any] = Depends(filter_query)
+        ):
+            # the whole collection as newline-delimited JSON, written a batch at a
+            # time as the cursor is read, so memory stays flat however big it is
+            sort_clause = self._parse_sort(sort)
+            filters = filters.copy() if filters else {}
+            if not deleted:
+                filters["_x"] = False
+            field_list = self._parse_fields(fields)
+            projection = self._projection(field_list) if field_list else None
+            chunks = self._export(repository.find(filters, sort_clause, batch_size=self.export_batch, projection=projection), field_list)
+            headers = {"Content-Disposition": f'attachment; filename="{entity_name}.ndjson"'}
+            if compress:
+                chunks = gzip_stream(chunks)
+                headers["Content-Encoding"] = "gzip"
+            return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
+
+        @router.get(f"{route_prefix}/snapshot")
+        async def snapshot_items(request: Request, compress: bool = Query(False, description="gzip the stream")):
+            # every item as newline-delimited JSON, with X-Last-Message-Id - a
+            # client that loads this and then replays messagesSince that id ends
+            # up current. The id is read before the documents, so anything up
+            # to it is in the snapshot; changes after it may be too, and
+            # replaying them again is harmless since clients check _v
+            last_id = await manager.log.last_id()
+            # nothing has changed since a snapshot at the same id - and if
+            # something is on its way, replaying from the id brings it
+            headers = {"X-Last-Message-Id": str(last_id), "ETag": f'W/"m{last_id}"', "Cache-Control": "no-store"}
+            if not_modified(request, headers):
+                return Response(status_code=304, headers=headers)
+            chunks = self._export(repository.find({"_x": False}, [("_id", 1)], batch_size=self.export_batch))
+            if compress:
+                chunks = gzip_stream(chunks)
+                headers["Content-Encoding"] = "gzip"
+            return StreamingResponse(chunks, media_type="application/x-ndjson", headers=headers)
 
         @router.post(f"{route_prefix}", response_model=Model)
         async def create_item(item: Model):  # type: ignore
             doc = item.model_dump(by_alias=True, exclude_none=True)
-            result = collection.insert_one(doc)
-            saved_doc = collection.find_one({"_id": result.inserted_id})
+            errors = self._key_errors(doc)
+            if errors:
+                raise HTTPException(status_code=422, detail=errors)
+            saved_doc = await repository.insert(doc)
             item = Model.model_validate(saved_doc)
             await manager.send_json({
                 "entity": f"{route_prefix}",
                 "mode": "create",
-                "key": result.inserted_id,
+                "key": item.id,
                 "data": item.model_dump(by_alias=True)
             })
             return item
 
         @router.get(f"{route_prefix}", response_model=List[Model])
-        def get_all_items(
+        async def get_all_items(
+            request: Request,
+            response: Response,
             skip: int = Query(0, ge=0),
-            limit: int = Query(50, le=100),
+            limit: int = Query(50, ge=1, le=1000),
             deleted: bool = False,
             sort: Optional[str] = Query(None, description="Comma-separated list of fields. Prefix with '-' for descending."),
-            filters: Dict[str, Any] = Depends(self._build_filter_query)
+            cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page."),
+            fields: Optional[str] = Query(None, description="Comma-separated list of fields to return. _id is always included."),
+            filters: Dict[str, Any] = Depends(filter_query)
         ):
             sort_clause = self._parse_sort(sort)
+            filters = filters.copy() if filters else {}
             if not deleted:
-                filters = filters.copy() if filters else {}
                 filters["_x"] = False
-            cursor = collection.find(filters).skip(skip).limit(limit)
-            if sort_clause:
-                cursor = cursor.sort(sort_clause)
-            return [Model.model_validate(doc) for doc in cursor]
+            if cursor:
+                filters = {"$and": [filters, self._after_cursor(sort_clause, cursor)]}
+            field_list = self._parse_fields(fields)
+            # the sort fields are fetched too, for the cursor, and the versions for the ETag
+            projection = self._projection(field_list + [f for f, _ in sort_clause] + ["_v", "_t"]) if field_list else None
+            docs = [doc async for doc in repository.find(filters, sort_clause, skip, limit, projection=projection)]
+            headers = list_validators(docs, str(request.query_params))
+            if len(docs) == limit:
+                headers["X-Next-Cursor"] = self._encode_cursor(sort_clause, docs[-1])
+            if not_modified(request, headers):
+                return Response(status_code=304, headers=headers)
+            if field_list:
+                return Response(json_bytes([self._partial(doc, field_list) for doc in docs]), media_type="application/json", headers=headers)
+            if self.trusted_reads:
+                return Response(json_bytes([self._plain(doc) for doc in docs]), media_type="application/json", headers=headers)
+            response.headers.update(headers)
+            return [Model.model_validate(doc) for doc in docs]
 
         @router.get(f"{route_prefix}/{{item_id}}", response_model=Model)
-        def get_single_item(item_id: str):
-            doc = collection.find_one({"_id": item_id})
+        async def get_single_item(
+            request: Request,
+            response: Response,
+            item_id: str,
+            fields: Optional[str] = Query(None, description="Comma-separated list of fields to return. _id is always included."),
+        ):
+            field_list = self._parse_fields(fields)
+            if self.trusted_reads and not field_list:
+                async def load():
+                    doc = await repository.get(item_id)
+                    return (json_bytes(self._plain(doc)), document_validators(doc)) if doc else None
+                cached = await cache.get((route_prefix, item_id), load)
+                if cached is None:
+                    raise HTTPException(status_code=404, detail="Item not found")
+                payload, headers = cached
+                if not_modified(request, headers):
+                    return Response(status_code=304, headers=headers)
+                return Response(payload, media_type="application/json", headers=headers)
+            projection = self._projection(field_list + ["_v", "_t"]) if field_list else None
+            doc = await repository.get(item_id, projection)
             if not doc:
                 raise HTTPException(status_code=404, detail="Item not found")
+            headers = document_validators(doc, ",".join(field_list))
+            if not_modified(request, headers):
+                return Response(status_code=304, headers=headers)
+            if field_list:
+                return Response(json_bytes(self._partial(doc, field_list)), media_type="application/json", headers=headers)
+            response.headers.update(headers)
             return Model.model_validate(doc)
 
         @router.put(f"{route_prefix}/{{item_id}}", response_model=Model)
         async def update_item(item_id: str, update_data: Model):  # type: ignore
             doc = update_data.model_dump(by_alias=True, exclude_none=True)
-            result = collection.update_one({"_id": item_id}, {"$set": doc})
-            if result.matched_count == 0:
+            return await self._update(route_prefix, item_id, doc)
+
+        @router.patch(f"{route_prefix}/{{item_id}}", response_model=Model)
+        async def patch_item(item_id: str, changes: Dict[str, Any] = Body(...)):
+            # just the fields to change, each validated on its own
+            return await self._update(route_prefix, item_id, self._validate_partial(changes))
+
+        @router.delete(f"{route_prefix}/{{item_id}}")
+        async def delete_item(item_id: str):
+            deleted_doc = await repository.delete(item_id)
+            if not deleted_doc:
                 raise HTTPException(status_code=404, detail="Item not found")
-            updated_doc = collection.find_one({"_id": item_id})
-            item = Model.model_validate(updated_doc)
+            item = Model.model_validate(deleted_doc)
             await manager.send_json({
                 "entity": f"{route_prefix}/{item_id}",
-                "mode": "update",
+                "mode": "delete",
                 "key": item_id,
                 "data": item.model_dump(by_alias=True)
             })
             return item
 
-        @router.delete(f"{route_prefix}/{{item_id}}")
-        async def delete_item(item_id: str):
-            deleted_doc = collection.find_one({"_id": item_id})
-            if not deleted_doc:
-                raise HTTPException(status_code=404, detail="Item not found")
-            # result = collection.delete_one({"_id": item_id})
-            print (deleted_doc)
-            deleted_doc["_x"] = True
-            result = collection.update_one({"_id": item_id}, {"$set": deleted_doc})
-            if result.matched_count == 0:
+        return router
+
+    async def _update(self, route_prefix: str, item_id: str, doc: dict):
+        errors = self._key_errors(doc)
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
+        if not self.deltas:
+            updated_doc = await self.repository.update(item_id, doc)
+            if not updated_doc:
                 raise HTTPException(status_code=404, detail="Item not found")
-            deleted_doc = collection.find_one({"_id": item_id})
-            item = Model.model_validate(deleted_doc)
+            item = self.model.model_validate(updated_doc)
             await manager.send_json({
                 "entity": f"{route_prefix}/{item_id}",
-                "mode": "delete",
+                "mode": "update",
                 "key": item_id,
                 "data": item.model_dump(by_alias=True)
             })
             return item
+        result = await self.repository.patch(item_id, doc)
+        if not result:
+            raise HTTPException(status_code=404, detail="Item not found")
+        before, after = result
+        item = self.model.model_validate(after)
+        await manager.send_json({
+            "entity": f"{route_prefix}/{item_id}",
+            "mode": "patch",
+            "key": item_id,
+            # clients holding version base apply delta, anyone else reloads
+            "base": before.get("_v", 0),
+            "delta": {k: v for k, v in after.items() if k not in before or before[k] != v}
+        })
+        return item
 
-        return router
+    def _key_errors(self, doc: dict) -> List[dict]:
+        # $set would take a dotted name for a path into a nested field, and a
+        # $ one for an operator - so the stored document wouldn't be doc
+        return [
+            {"type": "value_error", "loc": [key], "msg": "Field names can't contain '.' or start with '$'", "input": doc[key]}
+            for key in doc if "." in key or key.startswith("$")
+        ]
+
+    def _validate_partial(self, changes: Dict[str, Any]) -> dict:
+        doc = {}
+        errors = self._key_errors(changes)
+        for key, value in changes.items():
+            if key in ("_id", "_v") or "." in key or key.startswith("$"):
+                continue
+            adapter = self._adapters.get(key)
+            if not adapter:
+                # extra fields are allowed as they are
+                doc[key] = value
+                continue
+            try:
+                doc[key] = adapter.validate_python(value)
+            except ValidationError as e:
+                errors += [{**error, "loc": [key, *error["loc"]]} for error in e.errors(include_url=False)]
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
+        return doc
+
+    def _plain(self, doc: dict) -> dict:
+        # what model_dump(by_alias=True) would give for a document we wrote
+        # ourselves - the model's defaults filled in, extras kept as they are
+        return {**self._defaults, **doc}
+
+    # sparse fieldsets - fields= becomes a Mongo projection, and the response
+    # holds just those fields (plus _id), defaults filled in as for full reads
+
+    def _parse_fields(self, fields: Optional[str]) -> List[str]:
+        return [f.strip() for f in (fields or "").split(",") if f.strip()]
+
+    def _projection(self, field_list: List[str]) -> dict:
+        return {f: 1 for f in ["_id", *field_list]}
+
+    def _partial(self, doc: dict, field_list: List[str]) -> dict:
+        plain = self._plain(doc)
+        partial = {"_id": plain.get("_id")}
+        for field in field_list:
+            value = field_value(plain, field)
+            if value is not None or field in plain:
+                partial[field] = value
+        return partial
+
+    async def _export(self, docs: AsyncIterator[dict], field_list: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+        lines = []
+        async for doc in docs:
+            if field_list:
+                lines.append(json_bytes(self._partial(doc, field_list)))
+            elif self.trusted_reads:
+                lines.append(json_bytes(self._plain(doc)))
+            else:
+                lines.append(self.model.model_validate(doc).model_dump_json(by_alias=True).encode())
+            if len(lines) == self.export_batch:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+
+    def _check_batch(self, items: list):
+        if len(items) > self.bulk_limit:
+            raise HTTPException(status_code=413, detail=f"At most {self.bulk_limit} items per request")
+
+    def _validate_batch(self, items: List[Dict[str, Any]]) -> tuple:
+        # validates each item on its own so one bad item doesn't fail the batch -
+        # returns the results so far, and the docs to write (None where invalid)
+        self._check_batch(items)
+        results: List[Optional[dict]] = [None] * len(items)
+        docs: List[Optional[dict]] = [None] * len(items)
+        for i, raw in enumerate(items):
+            try:
+                item = self.model.model_validate(raw)
+            except ValidationError as e:
+                results[i] = {"_id": raw.get("_id") if isinstance(raw, dict) else None, "status": "invalid", "detail": e.errors(include_url=False)}
+                continue
+            doc = item.model_dump(by_alias=True, exclude_none=True)
+            errors = self._key_errors(doc)
+            if errors:
+                results[i] = {"_id": doc.get("_id"), "status": "invalid", "detail": errors}
+                continue
+            docs[i] = doc
+        return results, docs
+
+    async def _send_changes(self, route_prefix: str, mode: str, results: list, docs: list, written: Dict[str, dict],
+                            errors: Optional[Dict[str, str]] = None):
+        # fills in results for the docs that reached the repository, and broadcasts what was written
+        changes = []
+        for i, doc in enumerate(docs):
+            if doc is None or results[i] is not None:
+                continue
+            item_id = doc["_id"]
+            if errors and item_id in errors:
+                results[i] = {"_id": item_id, "status": "error", "detail": errors[item_id]}
+                continue
+            if item_id not in written:
+                results[i] = {"_id": item_id, "status": "not_found"}
+                continue
+            results[i] = {"_id": item_id, "status": f"{mode}d"}
+            changes.append({
+                "entity": f"{route_prefix}/{item_id}",
+                "mode": mode,
+                "key": item_id,
+                "data": self.model.model_validate(written[item_id]).model_dump(by_alias=True)
+            })
+        await self._send_bulk(route_prefix, changes)
+
+    async def _send_bulk(self, route_prefix: str, changes: List[dict]):
+        if changes:
+            await manager.send_json({
+                "entity": f"{route_prefix}",
+                "mode": "bulk",
+                "changes": changes
+            })
 
     def _build_filter_query(self):
-        annotations = get_type_hints(self.model)
+        # the list filters, built once per router from the model's fields:
+        # name=, name__in=, and for ordered types name__gt/gte/lt/lte= and for
+        # strings name__prefix= - each param maps to a (field, operator) pair
         fields = {}
+        operators = {}
 
-        for name, type_hint in annotations.items():
-            if name in ("id", "_id"):
+        for name, field in self.model.model_fields.items():
+            key = field.alias or name
+            if key == "_x":
+                # that's what deleted= is for
                 continue
-            fields[name] = (Optional[type_hint], Query(default=None))
+            type_hint = filter_type(field.annotation)
+            for op in FILTER_OPERATORS.get(type_hint, ()):
+                param = key if op == "eq" else f"{key}__{op}"
+                param_type = List[type_hint] if op == "in" else type_hint
+                fields[f"f{len(fields)}"] = (Optional[param_type], Field(default=None, alias=param))
+                operators[param] = (key, op)
 
         FilterModel = create_model(
             f"{self.entity_name.title()}Filters",
             __base__=BaseModel,
             **fields
         )
+        indexed = self._indexed_fields()
+
+        def filter_dependency(query: Annotated[FilterModel, Query()]) -> Dict[str, Any]:
+            filters: Dict[str, Any] = {}
+            for param, value in query.model_dump(by_alias=True, exclude_none=True).items():
+                key, op = operators[param]
+                if key not in indexed:
+                    raise HTTPException(status_code=400, detail=f"Can't filter on {key} - it isn't indexed")
+                if op == "eq":
+                    condition = {"$eq": value}
+                elif op == "prefix":
+                    # an anchored regex can still use the index
+                    condition = {"$regex": "^" + re.escape(value)}
+                else:
+                    condition = {f"${op}": value}
+                filters.setdefault(key, {}).update(condition)
+            return filters
 
-        async def filter_dependency(query: Any = Depends()):
-            return {k: v for k, v in query.model_dump(exclude_none=True).items()}
+        return filter_dependency
 
+    def _indexed_fields(self) -> set:
+        indexed = {"_id"}
+        for index in self.model.all_indexes():
+            indexed.update(index.document["key"])
+        return indexed
 
     def _parse_sort(self, sort: Optional[str]) -> List[tuple]:
-        if not sort:
-            return []
+        # always ends with _id, so every document has a unique position for
+        # cursors - in the direction of the last field so one index serves both
         sort_fields = []
-        for field in sort.split(","):
+        for field in (sort or "").split(","):
             field = field.strip()
+            if not field:
+                continue
             if field.startswith("-"):
                 sort_fields.append((field[1:], -1))
             else:
                 sort_fields.append((field, 1))
+        if "_id" not in (f for f, _ in sort_fields):
+            sort_fields.append(("_id", sort_fields[-1][1] if sort_fields else 1))
         return sort_fields
 
+    # keyset pagination - a cursor holds the sort values of the last document
+    # of a page, and the next page is everything sorted after them, so the
+    # query walks the index from there instead of skipping over earlier pages
+
+    def _encode_cursor(self, sort_clause: List[tuple], doc: dict) -> str:
+        values = [field_value(doc, field) for field, _ in sort_clause]
+        return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+    def _after_cursor(self, sort_clause: List[tuple], cursor: str) -> dict:
+        try:
+            values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if not isinstance(values, list) or len(values) != len(sort_clause):
+            raise HTTPException(status_code=400, detail="Cursor does not match sort")
+        # (a > x) or (a == x and b > y) or ... - where null (or missing) sorts
+        # before everything, and $gt / $lt never match it or match against it
+        clauses = []
+        for i, (field, direction) in enumerate(sort_clause):
+            clause = {f: v for (f, _), v in zip(sort_clause[:i], values)}
+            if values[i] is None:
+                if direction < 0:
+                    # nothing comes after null going down
+                    continue
+                clause[field] = {"$ne": None}
+            elif direction > 0:
+                clause[field] = {"$gt": values[i]}
+            else:
+                clause["$or"] = [{field: {"$lt": values[i]}}, {field: None}]
+            clauses.append(clause)
+        return {"$or": clauses}
 
 
 
-persons_collection = db["persons"]
+
+persons_repository = MongoRepository(db["persons"])
 
 class Person(MirraModel):
     name: str
 
+    indexes = [
+        IndexModel([("_x", 1), ("name", 1), ("_id", 1)]),
+    ]
+
 
 
 
-person_crud = CRUDRouterFactory(Person, persons_collection, "persons")
+person_crud = CRUDRouterFactory(Person, persons_repository, "persons")
 app.include_router(person_crud.get_router("/persons"))
 
 
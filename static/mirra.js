@@ -2,25 +2,60 @@ import { DateTime, Duration } from 'https://esm.sh/luxon';
 import { html, LitElement } from 'https://esm.sh/lit';
 import $ from 'https://esm.sh/jquery';
 import mitt from 'https://esm.sh/mitt';
+import { decode as unpack } from 'https://esm.sh/@msgpack/msgpack';
 
 
 class ReconnectingWebSocket {
     constructor(callback) {
         this.url = `ws://${location.host}/ws`;
+        // frame encodings we can read, best first - the server picks one it
+        // supports (or none, which means JSON text)
+        this.encodings = ['mirra.msgpack', 'mirra.json'];
         this.callback = callback;
         this.ws = null;
         this.backoff = 1000;      // 1 second
         this.maxBackoff = 30000;  // 30 seconds
         this.pingInterval = null;
+        // what this client watches - sent again on every (re)connect, since
+        // the server only knows about the socket they were sent on
+        this.subscriptions = [];
         this.connect();
     }
 
+    send(message) {
+        if (this.ws.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify(message));
+            return true;
+        }
+        return false;
+    }
+
+    // subscription is { entity, key } or { entity, filter, keys }, or a function
+    // returning one so it can say which keys it holds at the time it's sent
+    subscribe(subscription) {
+        this.subscriptions.push(subscription);
+        this.send({ action: "subscribe", ...this.#resolve(subscription) });
+    }
+
+    unsubscribe(subscription) {
+        this.subscriptions = this.subscriptions.filter(s => s !== subscription);
+        this.send({ action: "unsubscribe", ...this.#resolve(subscription) });
+    }
+
+    #resolve(subscription) {
+        return typeof subscription === 'function' ? subscription() : subscription;
+    }
+
     connect() {
-        this.ws = new WebSocket(this.url);
+        this.ws = new WebSocket(this.url, this.encodings);
+        this.ws.binaryType = 'arraybuffer';
 
         this.ws.onopen = () => {
             // console.log.log("WebSocket connected");
             this.backoff = 1000; // reset backoff
+            for (const subscription of this.subscriptions) {
+                this.send({ action: "subscribe", ...this.#resolve(subscription) });
+            }
 
             // Send heartbeat pings every 30 seconds
             // this.pingInterval = setInterval(() => {
@@ -31,7 +66,8 @@ class ReconnectingWebSocket {
         };
 
         this.ws.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            // binary frames are MessagePack, text frames JSON
+            const data = typeof event.data === 'string' ? JSON.parse(event.data) : unpack(new Uint8Array(event.data));
             // console.log("&&&&&&&&&&&&", data);
             if (data.type === "ping") {
                 // Server ping received, reply pong immediately
@@ -67,6 +103,106 @@ class ReconnectingWebSocket {
 // const ws = new ReconnectingWebSocket();
 
 
+// server copies of documents in IndexedDB, keyed by type and _id, with the
+// message id each type is current up to - so a page load can start from them
+// and replay what it missed instead of downloading everything again. Ids are
+// per type: another page may be keeping other types, up to other ids
+class MirraStore {
+    constructor(name) {
+        this.name = name;
+        this.pending = new Map();
+        this.clears = new Set();
+        this.meta = {};
+        this.timer = null;
+        // what the last page left - read before anything can be written over it
+        this.saved = {};
+        // (no IndexedDB - private browsing, say - and the store just does nothing)
+        this.db = null;
+        this.ready = this.#open().catch(() => this.db = null);
+    }
+
+    #request(request) {
+        return new Promise((resolve, reject) => {
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+    }
+
+    async #open() {
+        const request = indexedDB.open(this.name, 1);
+        request.onupgradeneeded = () => {
+            const items = request.result.createObjectStore('items', { keyPath: ['type', '_id'] });
+            items.createIndex('type', 'type');
+            request.result.createObjectStore('meta');
+        };
+        this.db = await this.#request(request);
+        const meta = this.db.transaction('meta').objectStore('meta');
+        const [keys, values] = await Promise.all([this.#request(meta.getAllKeys()), this.#request(meta.getAll())]);
+        keys.forEach((k, i) => this.saved[k] = values[i]);
+    }
+
+    // the documents stored for type, and the message id they're current to - or null
+    async load(type) {
+        await this.ready;
+        const lastMessageId = this.saved[`lastMessageId:${type}`];
+        if (!this.db || !this.saved[`complete:${type}`] || lastMessageId == null) return null;
+        const index = this.db.transaction('items').objectStore('items').index('type');
+        const rows = await this.#request(index.getAll(type));
+        return { items: rows.map(row => row.data), lastMessageId };
+    }
+
+    put(type, data) {
+        this.pending.set(`${type}/${data._id}`, { type, _id: data._id, data });
+        this.#schedule();
+    }
+
+    // everything stored for type is being replaced
+    clear(type) {
+        for (const [k, row] of this.pending) {
+            if (row.type === type) this.pending.delete(k);
+        }
+        this.clears.add(type);
+        this.meta[`complete:${type}`] = false;
+        this.#schedule();
+    }
+
+    // all of type is stored, current to lastMessageId
+    complete(type, lastMessageId) {
+        this.meta[`complete:${type}`] = true;
+        this.setLastMessageId(type, lastMessageId);
+    }
+
+    setLastMessageId(type, id) {
+        this.meta[`lastMessageId:${type}`] = id;
+        this.#schedule();
+    }
+
+    #schedule() {
+        this.timer ??= setTimeout(() => this.flush(), 100);
+    }
+
+    // one transaction for everything since the last flush - documents and the
+    // message id they're current to are stored together or not at all
+    async flush() {
+        await this.ready;
+        this.timer = null;
+        if (!this.db) return;
+        const clears = [...this.clears], rows = [...this.pending.values()], meta = this.meta;
+        this.clears = new Set();
+        this.pending = new Map();
+        this.meta = {};
+        const tx = this.db.transaction(['items', 'meta'], 'readwrite');
+        const items = tx.objectStore('items');
+        for (const type of clears) {
+            const keys = await this.#request(items.index('type').getAllKeys(type));
+            keys.forEach(k => items.delete(k));
+        }
+        rows.forEach(row => items.put(row));
+        Object.entries(meta).forEach(([k, v]) => tx.objectStore('meta').put(v, k));
+    }
+}
+
+
 export function err(message) {
     // console.error(message);
     throw new Error(message);
@@ -127,12 +263,22 @@ export class MirraSettings {
             ...this.fetch,
             ...settings.fetch
         }
+        this.store = {
+            ...this.store,
+            ...settings.store
+        }
     }
 
     fetch = {
         auto: true
     };
 
+    // keep server copies in IndexedDB between page loads
+    store = {
+        enabled: true,
+        name: 'mirra'
+    };
+
     // undo = {
     //     client: {
     //         enabled: false,
@@ -316,6 +462,7 @@ export class MirraModel {
     }
 
     static #registry = new Map();
+    static #paths = new Map();
 
     static #getItems(cls) {
         return MirraModel.#registry.get(cls);
@@ -337,44 +484,7 @@ export class MirraModel {
         // console.log(data);
         const cls = this.constructor;
 
-        if (!MirraModel.#registry.has(cls)) {
-            MirraModel.#registry.set(cls, {});
-        }
-
-        if (!MirraModel._initialised) {
-            MirraModel.ws = new ReconnectingWebSocket(data => {
-                // console.log.log("[ws]", data);
-                if (data.entity) {
-                    for (const [k, v] of MirraModel.#registry) {
-                        if (data.entity.startsWith(k.itemsPath)) {
-                            switch (data.mode) {
-                                case 'create':
-                                    // console.log.log('...', data.key);
-                                    // console.log.log(':::', MirraModel.#registry.get(cls)[data.key]);
-                                    if (!MirraModel.#registry.get(cls)[data.key]) {
-                                        // console.log.log(';;');
-                                        new k(data.data, data.key);
-                                    }
-                                    break;
-                                case 'update':
-                                    const o = v[data.entity.split('/')[2]];
-                                    // console.log.log("%", o);
-                                    o.load();
-                                    break;
-                                case 'delete':
-                                    const od = v[data.entity.split('/')[2]];
-                                    // console.log.log("%", od);
-                                    od.load();
-                                    break;
-                            };
-                        }
-                    }
-                }
-            });
-            MirraModel._initialised = true;
-            setTimeout(() => { console.log(MirraModel.#registry) }, 2000);
-        }
-
+        MirraModel.#watch(cls);
 
         if (key) {
             this.#persisted = true;
@@ -383,7 +493,16 @@ export class MirraModel {
             this.#key = crypto.randomUUID();
         }
         this.set(data);
+        if (key) {
+            // it came from the server - that's the server copy too
+            this.#data = { ...data };
+            Object.assign(this.#_data, this.#data);
+            this.#remember();
+        }
         MirraModel.#registry.get(cls)[this.#key] = this;
+        if (cls.watches === null) {
+            MirraModel.ws.subscribe({ entity: cls.itemsPath, key: this.#key });
+        }
 
         if (notify) {
             // console.log('n1');
@@ -394,6 +513,250 @@ export class MirraModel {
         // console.log('pc');
     }
 
+    // which changes the server sends for this type: {} is all of them,
+    // { filter: { field: value } } just the matching items, and null only the
+    // items this client holds
+    static get watches() {
+        return {};
+    }
+
+    static #store = null;
+
+    static #watch(cls) {
+        if (!MirraModel._initialised) {
+            if (MirraModel.settings.store.enabled && globalThis.indexedDB) {
+                MirraModel.#store = new MirraStore(MirraModel.settings.store.name);
+            }
+            MirraModel.ws = new ReconnectingWebSocket(data => MirraModel.#received(data));
+            MirraModel._initialised = true;
+            setTimeout(() => { console.log(MirraModel.#registry) }, 2000);
+        }
+        if (MirraModel.#registry.has(cls)) return;
+        MirraModel.#registry.set(cls, {});
+        MirraModel.#paths.set(cls.itemsPath, cls);
+        const watches = cls.watches;
+        if (watches?.filter) {
+            MirraModel.ws.subscribe(() => ({ entity: cls.itemsPath, filter: watches.filter, keys: Object.keys(MirraModel.#registry.get(cls)) }));
+        } else if (watches) {
+            MirraModel.ws.subscribe({ entity: cls.itemsPath });
+        }
+    }
+
+    // the highest message id we're up to date with - a reconnect replays from
+    // here. Live messages that arrive during a replay can be ahead of it, so
+    // they only count once the replay has caught up
+    static #lastMessageId = null;
+    static #replaying = false;
+    static #liveId = 0;
+    // the types whose stored message id follows ours: all of their items are
+    // here, every change to them comes in, and they've caught up. Restored
+    // types wait in catching until the replays in flight are done
+    static #current = new Set();
+    static #catching = new Set();
+    static #replays = 0;
+
+    static #received(data) {
+        // console.log.log("[ws]", data);
+        if (data.message?.last_message_id != null) {
+            // (re)connected - catch up on what we missed
+            const latest = data.message.last_message_id;
+            // (any replay on the last socket is gone with it)
+            MirraModel.#replays = 0;
+            if (MirraModel.#lastMessageId === null) {
+                MirraModel.#advance(latest);
+            } else if (latest > MirraModel.#lastMessageId) {
+                MirraModel.#catchUp();
+            } else {
+                MirraModel.#replaying = false;
+                MirraModel.#caughtUp();
+            }
+        } else if (data.messages) {
+            // a replay batch
+            for (const message of data.messages) {
+                MirraModel.#change(message);
+            }
+            MirraModel.#advance(data.last_id);
+        } else if (data.replay === 'end') {
+            MirraModel.#replaying = false;
+            if (--MirraModel.#replays <= 0) MirraModel.#caughtUp();
+            MirraModel.#advance(Math.max(data.last_id, MirraModel.#liveId));
+        } else if (data.resync) {
+            // too far behind to replay - load everything again
+            MirraModel.#replaying = false;
+            MirraModel.#replays = 0;
+            MirraModel.#catching.clear();
+            MirraModel.#resync();
+        } else if (data.entity !== undefined) {
+            MirraModel.#change(data);
+            // last_id, not the message's own id - with several server workers a
+            // lower id can still be on its way, and a replay has to cover it
+            const id = data.last_id ?? data.id;
+            if (MirraModel.#replaying) {
+                MirraModel.#liveId = Math.max(MirraModel.#liveId, id);
+            } else {
+                MirraModel.#advance(id);
+            }
+        }
+    }
+
+    static #advance(id) {
+        MirraModel.#lastMessageId = Math.max(MirraModel.#lastMessageId ?? 0, id);
+        for (const cls of MirraModel.#current) {
+            MirraModel.#store?.setLastMessageId(cls.type, MirraModel.#lastMessageId);
+        }
+    }
+
+    static #catchUp() {
+        // not connected yet - the connect message will bring us here again
+        MirraModel.#replaying = MirraModel.ws.send({ action: 'messagesSince', last_id: MirraModel.#lastMessageId });
+        if (MirraModel.#replaying) MirraModel.#replays++;
+    }
+
+    static #caughtUp() {
+        for (const cls of MirraModel.#catching) {
+            MirraModel.#current.add(cls);
+        }
+        MirraModel.#catching.clear();
+    }
+
+    // every item of cls is here and every change to it comes in
+    static #whole(cls) {
+        const watches = cls.watches;
+        return !!watches && !watches.filter;
+    }
+
+    // cls has just been loaded from the server - store it as complete, and
+    // keep its stored id following ours
+    static #keep(cls) {
+        if (!MirraModel.#whole(cls)) return;
+        MirraModel.#current.add(cls);
+        MirraModel.#store?.complete(cls.type, MirraModel.#lastMessageId);
+    }
+
+    // start from what's stored for cls, if it's all there - the socket then
+    // replays everything since it was stored
+    static async #restore(cls) {
+        if (!MirraModel.#whole(cls)) return false;
+        const saved = await MirraModel.#store?.load(cls.type).catch(() => null);
+        if (!saved) return false;
+        MirraModel.#restoring = true;
+        try {
+            for (const data of saved.items) {
+                cls._load(data);
+            }
+        } finally {
+            MirraModel.#restoring = false;
+        }
+        // replaying from before where other types are up to is harmless - _v
+        // keeps anything newer from being undone
+        MirraModel.#lastMessageId = Math.min(MirraModel.#lastMessageId ?? Infinity, saved.lastMessageId);
+        MirraModel.#catching.add(cls);
+        MirraModel.#catchUp();
+        return true;
+    }
+
+    static #restoring = false;
+
+    #remember() {
+        // (no need to store what we just read from the store)
+        if (!MirraModel.#restoring) {
+            MirraModel.#store?.put(this.type, this.#data);
+        }
+    }
+
+    static #change(data) {
+        if (data.mode === 'bulk') {
+            // one message for a whole bulk request - apply each change in turn
+            for (const change of data.changes) {
+                MirraModel.#apply(change);
+            }
+        } else {
+            MirraModel.#apply(data);
+        }
+    }
+
+    static async #resync() {
+        MirraModel.#lastMessageId = null;
+        for (const cls of MirraModel.#registry.keys()) {
+            if (cls._fetched) {
+                MirraModel.#current.delete(cls);
+                MirraModel.#store?.clear(cls.type);
+                await cls._fetch(true);
+                MirraModel.#keep(cls);
+            }
+        }
+    }
+
+    // a snapshot says which message id it's consistent with - replay from there
+    static _snapshotAt(lastMessageId) {
+        if (MirraModel.#replaying) {
+            // other types are still catching up to it
+            MirraModel.#liveId = Math.max(MirraModel.#liveId, lastMessageId);
+        } else {
+            MirraModel.#advance(lastMessageId);
+        }
+    }
+
+    // a document from the server - created, or applied to the one we hold if it's newer
+    static _load(data) {
+        const o = this.item(data._id);
+        if (o) {
+            o.#receive(data);
+        } else {
+            new this(data, data._id);
+        }
+    }
+
+    // after loading a complete set - anything we hold that it doesn't have was deleted meanwhile
+    static _prune(keys) {
+        for (const o of this.items()) {
+            if (o.#persisted && !keys.has(o.key) && !o.#data._x) {
+                o.#receive({ ...o.#data, _x: true });
+            }
+        }
+    }
+
+    // apply a change message from the server
+    static #apply(data) {
+        const path = data.key != null && data.entity.endsWith(`/${data.key}`) ? data.entity.slice(0, -data.key.length - 1) : data.entity;
+        const k = MirraModel.#paths.get(path);
+        if (k) {
+            const v = MirraModel.#registry.get(k);
+            switch (data.mode) {
+                case 'create':
+                    // console.log.log('...', data.key);
+                    if (!v[data.key]) {
+                        // console.log.log(';;');
+                        new k(data.data, data.key);
+                    } else {
+                        // a compacted log can fold later changes into the create
+                        v[data.key].#receive(data.data);
+                    }
+                    break;
+                case 'update':
+                case 'delete':
+                    // the message carries the whole document - no need to go back to the server
+                    const o = v[data.key];
+                    // console.log.log("%", o);
+                    if (o) {
+                        o.#receive(data.data);
+                    } else if (data.mode === 'update') {
+                        new k(data.data, data.key);
+                    }
+                    break;
+                case 'patch':
+                    // just the changed fields, and the version they were made from
+                    if (v[data.key]) {
+                        v[data.key].#patch(data.base, data.delta);
+                    } else if (k.watches?.filter) {
+                        // an edit brought it into the filter - we need all of it, not just what changed
+                        k._readKey(data.key).then(doc => doc && k._load(doc), () => null);
+                    }
+                    break;
+            };
+        }
+    }
+
     static get type() {
         throw "Subclass must override 'static get type()'";
     }
@@ -464,10 +827,16 @@ export class MirraModel {
 
 
     static async fetch(initial = false) {
+        // subscribe before fetching, so no change falls in between
+        MirraModel.#watch(this);
         if (!initial || !this._fetched) {
             // console.log.log('FETCHING!!!');
+            const first = !this._fetched;
             this._fetched = true;
+            // the first time, what was stored last time will do
+            if (first && await MirraModel.#restore(this)) return;
             await this._fetch();
+            MirraModel.#keep(this);
         }
     }
 
@@ -532,7 +901,9 @@ export class MirraModel {
     // load data from server and sync with client object
     async load() {
         // let t = this.#_t, u = this.#_u;
-        this.#data = await this._read();
+        const data = await this._read();
+        // undefined - the server says what we have is current
+        if (data !== undefined) this.#data = data;
 
 
         // if (t && u && (t != this.#_t || u != this.#_u)) {
@@ -544,6 +915,7 @@ export class MirraModel {
         Object.assign(this.#_data, this.#data);
         // }
         this.#persisted = true;
+        this.#remember();
 
         // console.log.log("$$$$$$$$$$$$$$$$$$$$$$$$$$$", this.#_data);
         // console.log(this.#data);
@@ -551,6 +923,35 @@ export class MirraModel {
         bus.emit(this.itemPath, { event: 'updated', data: this.#_data });
     }
 
+    // apply a document pushed by the server - ignored if it's older than what we have
+    #receive(data) {
+        if (data._v != null && this.#data._v != null) {
+            if (data._v < this.#data._v) return;
+        } else if (data._t != null && this.#data._t != null && data._t < this.#data._t) {
+            return;
+        }
+        this.#data = data;
+        Object.assign(this.#_data, this.#data);
+        this.#persisted = true;
+        this.#remember();
+        bus.emit(this.itemPath, { event: 'updated', data: this.#_data });
+    }
+
+    // apply changed fields pushed by the server - only onto the version they
+    // were made from; if we've missed a change in between, load the whole thing
+    #patch(base, delta) {
+        const version = this.#data._v ?? 0;
+        if (version === base) {
+            Object.assign(this.#data, delta);
+            Object.assign(this.#_data, delta);
+            this.#persisted = true;
+            this.#remember();
+            bus.emit(this.itemPath, { event: 'updated', data: this.#_data });
+        } else if (version < delta._v) {
+            this.load();
+        }
+    }
+
     // save data to server 
     async save() {
         // console.log(1);
@@ -568,7 +969,12 @@ export class MirraModel {
         //     }
         // } else {
         if (this.#persisted) {
-            await this._update(this.#_data);
+            // only what differs from the server copy
+            const changes = {};
+            for (const [k, v] of Object.entries(this.#_data)) {
+                if (this.#data[k] !== v) changes[k] = v;
+            }
+            await this._update(changes);
         } else {
             await this._create(this.#_data);
             this.#persisted = true;
@@ -601,31 +1007,90 @@ export class MirraModel {
         bus.emit(this.itemPath, { event: 'deleted', data: data });
     }
 
+    // save many objects of this type with one request per kind of write
+    static async saveAll(items) {
+        const creates = items.filter(o => !o.#persisted);
+        const updates = items.filter(o => o.#persisted);
+        for (const o of items) {
+            bus.emit(o.itemPath, { event: 'saving', data: o.#_data });
+        }
+        // the bulk routes answer with one {_id, status} per item, in order
+        const results = new Map();
+        if (creates.length) {
+            const created = await this._createMany(creates.map(o => ({ ...o.#_data, _id: o.key })));
+            creates.forEach((o, i) => {
+                results.set(o, created[i]);
+                // anything the server didn't create is still unsaved - the next save() creates it
+                if (created[i]?.status === 'created') o.#persisted = true;
+            });
+        }
+        if (updates.length) {
+            const updated = await this._updateMany(updates.map(o => ({ ...o.#_data, _id: o.key })));
+            updates.forEach((o, i) => results.set(o, updated[i]));
+        }
+        for (const o of items) {
+            const result = results.get(o);
+            const saved = result?.status === 'created' || result?.status === 'updated';
+            bus.emit(o.itemPath, { event: saved ? 'saved' : 'failed', data: o.#_data, result: result });
+        }
+        return items.map(o => results.get(o));
+    }
+
+    static async deleteAll(items) {
+        for (const o of items) {
+            bus.emit(o.itemPath, { event: 'deleting', data: o.#_data });
+        }
+        await this._deleteMany(items.map(o => o.key));
+        for (const o of items) {
+            bus.emit(o.itemPath, { event: 'deleted', data: o.#_data });
+        }
+    }
+
     static async _fetch(data) { }
+    static async _readKey(key) { }
     async _create(data) { }
     async _read() { }
     async _update(data) { }
     async _delete() { }
+    static async _createMany(datas) { }
+    static async _updateMany(datas) { }
+    static async _deleteMany(keys) { }
 
 }
 
 
 export class MirraModelMongoDB extends MirraModel {
-    static async _fetch() {
+    static async _fetch(resync = false) {
         // console.log("^^^^^^^");
-        // fetch records according to the criteria and/or policies
-        const result = await fetch("/" + this.type, {
-            method: "GET",
-            headers: { "Content-Type": "application/json" }
-        });
-        if (check(result)) {
-            const datas = await result.json();
-            // console.log("*****", datas);
-            // return data;
-            for (const data of datas) {
-                new this(data, data._id);
+        // everything, streamed as newline-delimited JSON, along with the
+        // message id it's consistent with - the socket replays from there.
+        // If nothing has changed since our last one, the server says so (304)
+        // - unless we're resyncing, and have thrown what we had away
+        const headers = !resync && this._snapshotTag ? { "If-None-Match": this._snapshotTag } : {};
+        const result = await fetch(`/${this.type}/snapshot?compress=true`, { headers });
+        if (result.status === 304) return;
+        if (!check(result)) return;
+        this._snapshotTag = result.headers.get("ETag");
+        const keys = new Set();
+        const reader = result.body.pipeThrough(new TextDecoderStream()).getReader();
+        let rest = '';
+        for (;;) {
+            const { value, done } = await reader.read();
+            const lines = (rest + (value ?? '')).split('\n');
+            rest = done ? '' : lines.pop();
+            for (const line of lines) {
+                if (!line) continue;
+                const data = JSON.parse(line);
+                keys.add(data._id);
+                this._load(data);
             }
+            if (done) break;
         }
+        if (resync) this._prune(keys);
+        this._snapshotAt(Number(result.headers.get("X-Last-Message-Id")));
+    }
+    static async _readKey(key) {
+        return await f("GET", `/${this.type}/${key}`);
     }
     async _create(data) {
 
@@ -644,8 +1109,12 @@ export class MirraModelMongoDB extends MirraModel {
     }
     async _read() {
         // console.log(1, `/${this.type}/${this.key}`);
-        const result = await fetch(`/${this.type}/${this.key}`);
+        // conditional on the version we last read - undefined when it's unchanged
+        const headers = this._etag ? { "If-None-Match": this._etag } : {};
+        const result = await fetch(`/${this.type}/${this.key}`, { headers });
         // console.log(2, result);
+        if (result.status === 304) return undefined;
+        this._etag = result.headers.get("ETag");
         let data = await result.json();
         // console.log(3, data);
         return data;
@@ -654,12 +1123,9 @@ export class MirraModelMongoDB extends MirraModel {
         // console.log(1, `/${this.type}/${this.key}`);
         // console.log({            ...data,            _id: this.key,        });
         await fetch(`/${this.type}/${this.key}`, {
-            method: "PUT",
+            method: "PATCH",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
-                ...data,
-                _id: this.key,
-            })
+            body: JSON.stringify(data)
         });
     }
     async _delete() {
@@ -675,6 +1141,24 @@ export class MirraModelMongoDB extends MirraModel {
 
     }
 
+    // the bulk endpoints take up to 1000 items per request
+    static async _bulk(method, items) {
+        const results = [];
+        for (let i = 0; i < items.length; i += 1000) {
+            results.push(...await f(method, `/${this.type}/bulk`, items.slice(i, i + 1000)));
+        }
+        return results;
+    }
+    static async _createMany(datas) {
+        return await this._bulk("POST", datas);
+    }
+    static async _updateMany(datas) {
+        return await this._bulk("PUT", datas);
+    }
+    static async _deleteMany(keys) {
+        return await this._bulk("DELETE", keys);
+    }
+
 }
 
 
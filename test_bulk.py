@@ -0,0 +1,57 @@
+import asyncio
+
+import httpx
+
+import main
+from bench import MemoryRepository, make_app, seed
+
+# the bulk routes against the in-memory repository from bench.py - run with pytest
+
+
+def bulk(method, items, docs=2):
+    # one request to /persons/bulk - the results, and the broadcast changes
+    repository = MemoryRepository(latency=0, slow_every=0)
+    seed(repository, docs)
+    app = make_app(repository)
+
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            r = await http.request(method, "/persons/bulk", json=items)
+            r.raise_for_status()
+            return r.json()
+
+    results = asyncio.run(request())
+    return results, [change for msg in main.manager.log.messages for change in msg.get("changes") or [msg]]
+
+
+def test_create_nothing():
+    assert bulk("POST", []) == ([], [])
+
+
+def test_create_only_invalid_items():
+    results, changes = bulk("POST", [{"name": 1}, {"_id": "n1", "name": "a", "b.c": 1}])
+    assert [r["status"] for r in results] == ["invalid", "invalid"]
+    assert changes == []
+
+
+def test_create_duplicate_ids():
+    results, changes = bulk("POST", [{"_id": "n1", "name": "a"}, {"_id": "n1", "name": "b"}, {"_id": "p0", "name": "c"}])
+    assert [r["status"] for r in results] == ["created", "error", "error"]
+    assert [(c["mode"], c["key"], c["data"]["name"]) for c in changes] == [("create", "n1", "a")]
+
+
+def test_update_duplicate_ids():
+    results, changes = bulk("PUT", [{"_id": "p0", "name": "a"}, {"_id": "p0", "name": "b"}, {"_id": "p9", "name": "c"}])
+    assert [r["status"] for r in results] == ["updated", "invalid", "not_found"]
+    assert [(c["key"], c["data"]["name"]) for c in changes] == [("p0", "a")]
+
+
+def test_delete_nothing():
+    assert bulk("DELETE", []) == ([], [])
+
+
+def test_delete_duplicate_ids():
+    results, changes = bulk("DELETE", ["p0", "p0", "p1", "p9"])
+    assert [r["status"] for r in results] == ["deleted", "invalid", "deleted", "not_found"]
+    assert [(c["mode"], c["key"]) for c in changes] == [("delete", "p0"), ("delete", "p1")]
@@ -0,0 +1,188 @@
+import asyncio
+
+from pymongo import DeleteMany
+
+from main import MessageLog, coalesce, compacted
+
+# the merge rules behind coalescing and message log compaction - run with pytest
+
+
+def patch(key, base, **delta):
+    return {"entity": f"/persons/{key}", "mode": "patch", "key": key, "base": base, "delta": {**delta, "_v": base + 1}}
+
+
+def create(key, **data):
+    return {"entity": "/persons", "mode": "create", "key": key, "data": {"_id": key, **data, "_v": 1}}
+
+
+def update(key, v, **data):
+    return {"entity": f"/persons/{key}", "mode": "update", "key": key, "data": {"_id": key, **data, "_v": v}}
+
+
+def bulk(*changes):
+    return {"entity": "/persons", "mode": "bulk", "changes": list(changes)}
+
+
+def numbered(*messages):
+    return [{**msg, "id": i + 1} for i, msg in enumerate(messages)]
+
+
+def replayed(messages, docs=None):
+    # the documents a client ends up with, applying messages the way mirra.js does
+    docs = {k: dict(v) for k, v in (docs or {}).items()}
+    for msg in messages:
+        for change in msg.get("changes") or [msg]:
+            doc = docs.get(change["key"])
+            if change["mode"] == "patch":
+                if doc and doc["_v"] == change["base"]:
+                    docs[change["key"]] = {**doc, **change["delta"]}
+            elif not doc or doc["_v"] <= change["data"]["_v"]:
+                docs[change["key"]] = dict(change["data"])
+    return docs
+
+
+def test_coalesce_patches_keep_the_first_base():
+    merged = coalesce(patch("p1", 1, name="a"), patch("p1", 2, age=3))
+    assert merged["base"] == 1
+    assert merged["delta"] == {"name": "a", "age": 3, "_v": 3}
+
+
+def test_coalesce_patch_onto_a_whole_document():
+    merged = coalesce(update("p1", 4, name="a", age=1), patch("p1", 4, age=2))
+    assert merged["mode"] == "update"
+    assert merged["data"] == {"_id": "p1", "name": "a", "age": 2, "_v": 5}
+
+
+def test_coalesce_keeps_create():
+    merged = coalesce(create("p1", name="a"), update("p1", 2, name="b"))
+    assert merged["mode"] == "create"
+    assert merged["data"]["name"] == "b"
+    merged = coalesce(create("p1", name="a"), patch("p1", 1, name="c"))
+    assert merged["mode"] == "create"
+    assert merged["data"] == {"_id": "p1", "name": "c", "_v": 2}
+
+
+def test_coalesce_delete_wins():
+    deleted = {**update("p1", 3, name="a", _x=True), "mode": "delete"}
+    assert coalesce(patch("p1", 1, name="b"), deleted) is deleted
+
+
+def test_compacted_leaves_each_item_in_its_last_message():
+    messages = numbered(create("p1", name="a"), create("p2", name="x"), patch("p1", 1, name="b"), patch("p1", 2, name="c"))
+    deletes, rewrites = compacted(messages)
+    assert deletes == [1, 3]
+    assert [m["id"] for m in rewrites] == [4]
+    assert rewrites[0]["mode"] == "create"
+    assert rewrites[0]["data"]["name"] == "c"
+
+
+def test_compacted_splits_bulk_messages():
+    messages = numbered(bulk(create("p1", name="a"), create("p2", name="x")), patch("p1", 1, name="b"))
+    deletes, rewrites = compacted(messages)
+    assert deletes == []
+    first = next(m for m in rewrites if m["id"] == 1)
+    # one change left - it's no longer a bulk message
+    assert first["mode"] == "create" and first["key"] == "p2"
+
+
+def test_compacted_untouched_messages_are_left_alone():
+    messages = numbered(create("p1", name="a"), create("p2", name="x"))
+    assert compacted(messages) == ([], [])
+
+
+def test_compacted_replays_to_the_same_documents_from_any_id():
+    messages = numbered(
+        create("p1", name="a"), create("p2", name="x"), patch("p1", 1, name="b"),
+        bulk(patch("p1", 2, name="c"), patch("p2", 1, name="y")), update("p2", 3, name="z"), patch("p1", 3, age=4),
+    )
+    deletes, rewrites = compacted(messages)
+    rewritten = {m["id"]: m for m in rewrites}
+    kept = [rewritten.get(m["id"], m) for m in messages if m["id"] not in deletes]
+    for since in range(len(messages) + 1):
+        held = replayed(messages[:since])
+        assert replayed([m for m in kept if m["id"] > since], held) == replayed(messages)
+
+
+class Cursor:
+    def __init__(self, collection, docs):
+        self.collection = collection
+        self.docs = docs
+
+    def sort(self, key, direction):
+        self.docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n] if n else self.docs
+        return self
+
+    async def to_list(self):
+        self.collection.read += len(self.docs)
+        return self.docs
+
+
+class Messages:
+    # the part of a collection MessageLog.compact uses
+    def __init__(self, messages):
+        self.docs = {m["id"]: dict(m) for m in messages}
+        self.read = 0
+
+    def find(self, query, projection=None):
+        bounds = query["id"]
+        return Cursor(self, [dict(d) for i, d in self.docs.items() if bounds.get("$gt", 0) < i <= bounds["$lte"]])
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            if isinstance(op, DeleteMany):
+                for i in op._filter["id"]["$in"]:
+                    self.docs.pop(i)
+            else:
+                self.docs[op._filter["id"]] = op._doc
+
+
+class Counters:
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"], "seq": 0})
+        doc["seq"] = max(doc["seq"], update["$max"]["seq"])
+
+
+def edits(items, changes):
+    truth, messages = {}, []
+    for i in range(changes):
+        key = f"p{i % items}"
+        if key not in truth:
+            truth[key] = 1
+            messages.append(create(key, name="new"))
+        else:
+            messages.append(patch(key, truth[key], name=f"edit {i}"))
+            truth[key] += 1
+    return numbered(*messages)
+
+
+def test_compact_in_batches_matches_compacting_at_once():
+    messages = edits(items=20, changes=1000)
+    log = MessageLog({"messages": Messages(messages), "counters": Counters()})
+    asyncio.run(log.compact(900, batch=100))
+    deletes, rewrites = compacted([m for m in messages if m["id"] <= 900])
+    rewritten = {m["id"]: m for m in rewrites}
+    expected = {m["id"]: rewritten.get(m["id"], m) for m in messages if m["id"] not in deletes}
+    assert log.messages.docs == expected
+    assert replayed(log.messages.docs.values()) == replayed(messages)
+
+
+def test_compact_starts_from_where_it_got_to():
+    messages = edits(items=20, changes=1000)
+    log = MessageLog({"messages": Messages(messages), "counters": Counters()})
+    asyncio.run(log.compact(500, batch=100))
+    assert log.counters.docs["messages_compacted"]["seq"] == 500
+    log.messages.read = 0
+    asyncio.run(log.compact(900, batch=100))
+    # only what's past the last run is read again
+    assert log.messages.read == 400
+    assert replayed(log.messages.docs.values()) == replayed(messages)
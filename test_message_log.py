@@ -0,0 +1,141 @@
+import asyncio
+import re
+
+from main import MessageLog
+
+# message ids across workers - last_id() never gets ahead of an id another
+# worker may still deliver - run with pytest
+
+
+class Counters:
+    # the part of counters MessageLog uses, recording mark changes in commit order
+    def __init__(self, stream):
+        self.stream = stream
+        self.docs = {}
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"], "seq": 0})
+        doc["seq"] += update["$inc"]["seq"]
+        return dict(doc)
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs[query["_id"]] = {"_id": query["_id"], **doc}
+        self.stream.append(("low", query["_id"].removeprefix("messages_low:"), doc["seq"]))
+
+    async def _find(self, pattern):
+        for doc in list(self.docs.values()):
+            if re.match(pattern, doc["_id"]):
+                yield doc
+
+    def find(self, query):
+        return self._find(query["_id"]["$regex"])
+
+
+class Messages:
+    def __init__(self, stream):
+        self.stream = stream
+        # ids whose insert waits for the event
+        self.slow: dict[int, asyncio.Event] = {}
+
+    async def insert_one(self, doc):
+        if doc["id"] in self.slow:
+            await self.slow[doc["id"]].wait()
+        self.stream.append(("msg", doc["id"]))
+
+
+class Worker:
+    # a MessageLog and how far through the change stream it has read
+    def __init__(self, db, stream):
+        self.log = MessageLog(db, block=10, shared=True)
+        self.log.high = 0
+        self.stream = stream
+        self.read = 0
+
+    def catch_up(self):
+        for event in self.stream[self.read:]:
+            if event[0] == "msg":
+                self.log.seen(event[1])
+                self.log.delivered(event[1])
+            else:
+                self.log.heard(event[1], event[2])
+        self.read = len(self.stream)
+
+
+def cluster(workers=2):
+    stream = []
+    db = {"messages": Messages(stream), "counters": Counters(stream)}
+    return db, [Worker(db, stream) for _ in range(workers)]
+
+
+def test_one_worker_stops_at_its_first_unsent_id():
+    log = MessageLog({"messages": None, "counters": None})
+    log.high = 7
+    assert log.low_water() == 7
+    log.unsent = {8, 9}
+    log.high = 9
+    assert log.low_water() == 7
+
+
+def test_last_id_waits_for_another_workers_id_in_flight():
+    async def run():
+        db, (a, b) = cluster()
+        db["messages"].slow[1] = asyncio.Event()
+        slow = asyncio.create_task(a.log.append({"key": "a"}))
+        await asyncio.sleep(0)
+        await b.log.append({"key": "b"})
+        a.catch_up()
+        b.catch_up()
+        # b's id is past a's block, and a's id 1 isn't in yet
+        assert b.log.high == 11
+        assert b.log.low_water() == 0
+        db["messages"].slow[1].set()
+        await slow
+        a.catch_up()
+        await a.log.sync()
+        b.catch_up()
+        # a is done and has given up the rest of its block
+        assert a.log.low() is None
+        assert b.log.low_water() == 11
+    asyncio.run(run())
+
+
+def test_marks_arrive_after_the_messages_before_them():
+    async def run():
+        db, (a, b) = cluster()
+        await a.log.append({"key": "a"})
+        await a.log.append({"key": "a"})
+        # b hasn't read as far as a's messages - what a publishes after them
+        # can't move b past them either
+        a.catch_up()
+        await a.log.sync()
+        assert b.log.low_water() == 0
+        b.catch_up()
+        assert b.log.low_water() == 2
+    asyncio.run(run())
+
+
+def test_blocks_are_reserved_once_per_block():
+    async def run():
+        db, (a,) = cluster(1)
+        for _ in range(25):
+            await a.log.append({"key": "a"})
+        a.catch_up()
+        assert db["counters"].docs["messages"]["seq"] == 30
+        assert a.log.low_water() == 25
+    asyncio.run(run())
+
+
+def test_a_worker_that_stops_stops_counting():
+    async def run():
+        db, (a, b) = cluster()
+        await a.log.append({"key": "a"})
+        a.catch_up()
+        await a.log.sync()
+        b.catch_up()
+        # a still has 2..10 to hand out
+        assert b.log.low_water() == 1
+        a.log.syncer = asyncio.create_task(asyncio.sleep(10))
+        await a.log.stop()
+        b.catch_up()
+        assert b.log.lows == {}
+    asyncio.run(run())